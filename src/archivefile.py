@@ -52,6 +52,9 @@ class ArchiveFile(ImageFile):
     def can_be_extracted(self):
         return True
 
+    def can_be_decoded(self):
+        return False
+
 class ZIPFile:
     def __init__(self, filename):
         self.filename = filename
@@ -1,14 +1,24 @@
 # Cache implementation
+import os
 import time
+import math
+import shelve
 
 from threading import Lock
 
 class Cache:
-    def __init__(self, limit=None, shared=False, debug=False, top_cache=None):
+    def __init__(self, limit=None, shared=False, debug=False, top_cache=None,
+                       max_size=None, sizeof=None):
         self.limit = limit
         self.shared = shared
         self.debug = debug
 
+        # Optional memory budget (sizeof must return the size of a value):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.sizes = {}
+
         self.keys = []
         self.lock = Lock()
         self.store = {}
@@ -19,18 +29,36 @@ class Cache:
         if top_cache:
             top_cache.add_chained(self)
 
-    def __add_key(self, key):
-        if self.limit is None:
+    def __is_bounded(self):
+        return self.limit is not None or self.max_size is not None
+
+    def __is_full(self):
+        return ((self.limit is not None and len(self.keys) > self.limit) or
+                (self.max_size is not None and self.size > self.max_size))
+
+    def __add_key(self, key, value):
+        if not self.__is_bounded():
             return
 
-        if len(self.keys) == self.limit:
-            older = self.keys.pop(0)
-            del self.store[older]
+        if self.max_size is not None:
+            self.sizes[key] = self.sizeof(value)
+            self.size += self.sizes[key]
 
         self.keys.append(key)
 
+        # The new entry is never evicted, even if it exceeds the budget:
+        while len(self.keys) > 1 and self.__is_full():
+            self.__remove_key(self.keys[0])
+
+    def __remove_key(self, key):
+        del self.store[key]
+        if key in self.sizes:
+            self.size -= self.sizes.pop(key)
+        if self.__is_bounded():
+            self.keys.remove(key)
+
     def __refresh_key(self, key):
-        if self.limit is None:
+        if not self.__is_bounded():
             return
 
         del self.keys[self.keys.index(key)]
@@ -50,8 +78,8 @@ class Cache:
             if key in self.store:
                 print("Warning, duplicate entry for", key)
                 return
-            self.__add_key(key)
             self.store[key] = value
+            self.__add_key(key, value)
 
     def __getitem__(self, key):
         with self.lock:
@@ -65,6 +93,25 @@ class Cache:
                 self.misses += 1
                 raise
 
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.store
+
+    # Evicts the given fraction of the entries (the least recently used
+    # ones first, if the cache is bounded). Returns the number of evicted
+    # entries and their size (if known):
+    def shrink(self, fraction):
+        with self.lock:
+            keys = list(self.keys if self.__is_bounded() else self.store)
+            keys = keys[:int(math.ceil(len(keys) * fraction))]
+
+            size = self.size
+            for key in keys:
+                self.trace("Evicting", key)
+                self.__remove_key(key)
+
+            return len(keys), size - self.size
+
     def add_chained(self, chained):
         self.chained.append(chained)
 
@@ -78,9 +125,7 @@ class Cache:
 
             for key in matches:
                 self.trace("Invalidating", key)
-                del self.store[key]
-                if self.keys:
-                    self.keys.remove(key)
+                self.__remove_key(key)
 
         for chained in self.chained:
             chained.invalidate(partial_key)
@@ -130,3 +175,86 @@ def cached(cache_=None, key_func=None):
         return wrapper
     return func
 
+
+# Disk backed cache, sharing the interface of Cache so it can be used
+# with the @cached decorator. Keys must be tuples of plain values, and
+# should include whatever makes an entry stale (e.g. the file mtime).
+# The entries are grouped in one record per first element of the key
+# (e.g. the filename), so the entries of a file can be invalidated or
+# moved at once, without going through the whole store.
+class PersistentCache:
+    default_dir = os.path.join(os.path.expanduser("~"), ".cache", "gtk-viewer")
+
+    def __init__(self, name, directory=None, debug=False):
+        self.path = os.path.join(directory or self.default_dir, name)
+        self.shared = True
+        self.debug = debug
+
+        self.lock = Lock()
+        self.store = None
+        self.hits = 0
+        self.misses = 0
+        self.chained = []
+
+    def __open(self):
+        if self.store is not None:
+            return
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self.store = shelve.open(self.path)
+        except Exception as e:
+            print("Warning: unable to open %s, not persisting (%s)" % (self.path, e))
+            self.store = {}
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.__open()
+            record = self.store.get(repr(key[0]), {})
+            record[repr(key[1:])] = value
+            self.store[repr(key[0])] = record
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.__open()
+            try:
+                value = self.store[repr(key[0])][repr(key[1:])]
+                self.trace(key, "found in the persistent cache")
+                self.hits += 1
+                return value
+            except:
+                self.misses += 1
+                raise
+
+    def add_chained(self, chained):
+        self.chained.append(chained)
+
+    # The partial key is the first element of the keys to invalidate:
+    def invalidate(self, partial_key):
+        with self.lock:
+            self.__open()
+            if self.store.pop(repr(partial_key), None) is not None:
+                self.trace("Invalidating", partial_key)
+
+        for chained in self.chained:
+            chained.invalidate(partial_key)
+
+    # The entries stay valid when their file is renamed (the mtime and
+    # the size don't change):
+    def move(self, partial_key, new_partial_key):
+        with self.lock:
+            self.__open()
+            record = self.store.pop(repr(partial_key), None)
+            if record is not None:
+                self.trace("Moving", partial_key, "to", new_partial_key)
+                self.store[repr(new_partial_key)] = record
+
+    def close(self):
+        with self.lock:
+            if hasattr(self.store, "close"):
+                self.store.close()
+            self.store = None
+
+    def trace(self, *args):
+        if self.debug: print(" ".join(map(str,args)))
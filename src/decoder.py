@@ -0,0 +1,67 @@
+# Optional decoder backend: the images are decoded (and scaled, if a size
+# is given) by a pool of processes, so decoding doesn't compete for the
+# GIL with the UI and scales across all the cores. The decoded pixels are
+# handed back through a file in shared memory (/dev/shm), so only the
+# description of the pixbuf goes through the pool's pipe.
+import os
+import tempfile
+import multiprocessing
+
+import gtk
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# This is done in a process of the pool:
+def decode(filename, width=None, height=None):
+    if width and height:
+        pixbuf = gtk.gdk.pixbuf_new_from_file_at_scale(filename, width, height, False)
+    else:
+        pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
+
+    fd, path = tempfile.mkstemp(prefix="gtk-viewer-", dir=SHM_DIR)
+    with os.fdopen(fd, "wb") as output:
+        output.write(pixbuf.get_pixels())
+
+    return (path, pixbuf.get_width(), pixbuf.get_height(),
+            pixbuf.get_rowstride(), pixbuf.get_has_alpha())
+
+class Decoder:
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes)
+
+    # Blocks the calling thread (but not the others) until the image is
+    # decoded:
+    def decode(self, filename, width=None, height=None):
+        path, width, height, rowstride, has_alpha = \
+            self.pool.apply(decode, (filename, width, height))
+
+        try:
+            with open(path, "rb") as input_:
+                data = input_.read()
+        finally:
+            os.unlink(path)
+
+        # The last row may not be padded to the rowstride:
+        data += b"\0" * (rowstride * height - len(data))
+
+        return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+                                            has_alpha, 8, width, height,
+                                            rowstride)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+# Not enabled by default. It must be enabled before any thread is started,
+# since the pool is forked:
+backend = None
+
+def enable(processes=None):
+    global backend
+    backend = Decoder(processes)
+
+def close():
+    global backend
+    if backend:
+        backend.close()
+        backend = None
@@ -0,0 +1,172 @@
+# Finds the files with the same contents. The candidates are narrowed in
+# passes of increasing cost, and only the files that are still in a group
+# go to the next pass:
+#  1. size (from the stat, no reads),
+#  2. hash of the first and last SAMPLE_SIZE bytes,
+#  3. hash of the full contents.
+# The reads are done by a pool of threads (the hashing releases the GIL),
+# so slow disks and network shares are kept busy.
+import os
+import hashlib
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+from cache import Cache
+
+SAMPLE_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Full hashes already computed, by file signature:
+hash_cache = Cache(limit=100000)
+
+def get_signature(filename, stat=None):
+    stat = stat or os.stat(filename)
+    return (filename, stat.st_mtime, stat.st_size)
+
+def get_cached_hash(filename, stat=None):
+    try:
+        return hash_cache[get_signature(filename, stat)]
+    except KeyError:
+        return None
+
+def get_sample_hash(filename, size):
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as input_:
+        sha1.update(input_.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            input_.seek(max(size - SAMPLE_SIZE, SAMPLE_SIZE))
+            sha1.update(input_.read(SAMPLE_SIZE))
+
+    return sha1.hexdigest()
+
+def get_full_hash(filename):
+    key = get_signature(filename)
+    try:
+        return hash_cache[key]
+    except KeyError:
+        pass
+
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as input_:
+        while True:
+            chunk = input_.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    value = sha1.hexdigest()
+    if key not in hash_cache:
+        hash_cache[key] = value
+    return value
+
+# Whether two files (of any type) have the same contents. The sizes are
+# compared first, then the hashes if both are known, and otherwise the
+# contents, chunk by chunk until the first difference:
+def have_same_contents(filename1, filename2):
+    stat1, stat2 = os.stat(filename1), os.stat(filename2)
+
+    if stat1.st_size != stat2.st_size:
+        return False
+
+    if (stat1.st_dev, stat1.st_ino) == (stat2.st_dev, stat2.st_ino):
+        return True
+
+    hash1 = get_cached_hash(filename1, stat1)
+    hash2 = get_cached_hash(filename2, stat2)
+    if hash1 and hash2:
+        return hash1 == hash2
+
+    with open(filename1, "rb") as input1:
+        with open(filename2, "rb") as input2:
+            while True:
+                chunk1 = input1.read(CHUNK_SIZE)
+                chunk2 = input2.read(CHUNK_SIZE)
+                if chunk1 != chunk2:
+                    return False
+                if not chunk1:
+                    return True
+
+class DuplicateFinder:
+    PASSES = 3
+
+    def __init__(self, files, threads=None):
+        self.files = files
+        self.threads = threads or max(multiprocessing.cpu_count(), 4)
+        self.groups = [] # lists of files with the same contents
+
+    # This is done in a separate thread:
+    def run(self):
+        pool = ThreadPool(self.threads)
+        try:
+            groups = [self.files]
+            for index, key in enumerate([self.get_nonempty_size,
+                                         self.get_sample_hash,
+                                         self.get_full_hash]):
+                candidates = list(groups_in(groups))
+                groups = []
+                for progress in self.split(pool, candidates, key, groups):
+                    yield (index + progress) / self.PASSES
+        finally:
+            pool.close()
+            pool.join()
+
+        # The biggest savings first:
+        groups.sort(key=lambda group: -self.get_size(group[0]))
+        self.groups = [sorted(group, key=lambda file_: file_.get_filename())
+                       for group in groups]
+
+    # Splits the groups of the candidates by the given key, adding the
+    # new groups with more than one file (unreadable and empty files are
+    # left out):
+    def split(self, pool, candidates, key, groups):
+        total = float(len(candidates)) or 1.0
+
+        def get_entry(candidate):
+            group, file_ = candidate
+            return group, file_, self.get_key(key, file_)
+
+        buckets = {}
+        results = pool.imap_unordered(get_entry, candidates, chunksize=16)
+        for index, (group, file_, value) in enumerate(results):
+            if value is not None:
+                buckets.setdefault((group, value), []).append(file_)
+            yield index / total
+
+        groups.extend(files for files in buckets.values() if len(files) > 1)
+
+    def get_key(self, key, file_):
+        try:
+            return key(file_)
+        except (IOError, OSError) as e:
+            print("Warning:", e)
+            return None
+
+    def get_size(self, file_):
+        return file_.get_stat().st_size
+
+    def get_nonempty_size(self, file_):
+        return self.get_size(file_) or None
+
+    def get_sample_hash(self, file_):
+        return get_sample_hash(file_.get_filename(), self.get_size(file_))
+
+    def get_full_hash(self, file_):
+        # The sample already covered all the contents (and the files of
+        # the group have the same sample), no need to read it again:
+        if self.get_size(file_) <= 2 * SAMPLE_SIZE:
+            return ""
+        return get_full_hash(file_.get_filename())
+
+    def get_redundant_size(self):
+        return sum(self.get_size(group[0]) * (len(group) - 1)
+                   for group in self.groups)
+
+# Pairs every file with the index of its group, so the files are only
+# compared with the ones of their own group:
+def groups_in(groups):
+    for index, files in enumerate(groups):
+        for file_ in files:
+            yield index, file_
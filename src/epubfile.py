@@ -14,6 +14,9 @@ class EPUBFile(ImageFile):
     valid_extensions = ["epub"]
     pixbuf_cache = Cache(10)
 
+    def can_be_decoded(self):
+        return False
+
     @cached(pixbuf_cache)
     def get_pixbuf(self):
         cover = self.get_cover()
@@ -0,0 +1,127 @@
+# Minimal EXIF reader: only the APP1 segment of JPEG files (or the
+# headers of TIFF files) is parsed, and only the simple values of the
+# main IFD (IFD0) and the thumbnail IFD (IFD1) are extracted. Full
+# decoding is left to PIL (see ImageFile.get_tags).
+# Format reference: http://www.exif.org/Exif2-2.PDF
+import struct
+
+ORIENTATION = 0x0112
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+
+# Only the headers of the file are read, this is a safety limit:
+MAX_HEADER_SIZE = 64 * 1024
+
+# The only files that can have EXIF data:
+EXTENSIONS = (".jpg", ".jpeg", ".jpe", ".jfif", ".tif", ".tiff")
+
+def has_exif(filename):
+    return filename.lower().endswith(EXTENSIONS)
+
+# type id: (struct format, size)
+TYPES = {1: ("B", 1),  # BYTE
+         2: ("c", 1),  # ASCII
+         3: ("H", 2),  # SHORT
+         4: ("L", 4),  # LONG
+         7: ("B", 1),  # UNDEFINED
+         9: ("l", 4)}  # SLONG
+
+# Returns the TIFF data of the APP1 segment and its offset in the file:
+def find_app1(input_):
+    if input_.read(2) != b"\xff\xd8":
+        return None
+
+    while input_.tell() < MAX_HEADER_SIZE:
+        header = input_.read(4)
+        if len(header) < 4 or header[0:1] != b"\xff":
+            return None
+
+        marker, length = struct.unpack(">BH", header[1:])
+
+        if marker == 0xe1:
+            start = input_.tell() + 6
+            segment = input_.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                return segment[6:], start
+        elif 0xe0 <= marker <= 0xef or marker == 0xfe:
+            input_.seek(length - 2, 1)
+        else:
+            # APPn and COM segments are before the image data
+            return None
+
+    return None
+
+def parse_ifd(tiff, offset, order):
+    entries = {}
+
+    count, = struct.unpack(order + "H", tiff[offset:offset+2])
+    for index in range(count):
+        start = offset + 2 + index * 12
+        tag, type_, items = struct.unpack(order + "HHL", tiff[start:start+8])
+
+        if type_ not in TYPES:
+            continue
+
+        format_, size = TYPES[type_]
+        if size * items <= 4:
+            data = tiff[start+8:start+8+size*items]
+        else:
+            value_offset, = struct.unpack(order + "L", tiff[start+8:start+12])
+            data = tiff[value_offset:value_offset+size*items]
+
+        if len(data) != size * items:
+            continue
+
+        if type_ == 2:
+            entries[tag] = data.rstrip(b"\x00").decode("latin-1")
+        elif items == 1:
+            entries[tag], = struct.unpack(order + format_, data)
+
+    next_offset, = struct.unpack(order + "L", tiff[offset+2+count*12:offset+6+count*12])
+    return entries, next_offset
+
+def parse_tiff(tiff):
+    order = {b"II": "<", b"MM": ">"}.get(tiff[0:2])
+    if not order:
+        return {}
+
+    ifds = {}
+    offset, = struct.unpack(order + "L", tiff[4:8])
+    for name in ("ifd0", "ifd1"):
+        if not offset or offset >= len(tiff):
+            break
+        ifds[name], offset = parse_ifd(tiff, offset, order)
+
+    return ifds
+
+# Returns a dict with the "ifd0" and "ifd1" entries (as dicts indexed by
+# tag id) and, if there's an embedded JPEG thumbnail, a "thumbnail" entry
+# with its (offset, length) in the file. It raises IOError if the file
+# can't be read, but malformed EXIF data is ignored.
+def read_exif(filename):
+    with open(filename, "rb") as input_:
+        if input_.read(4) in (b"II*\x00", b"MM\x00*"):
+            # A TIFF file is its own EXIF data:
+            input_.seek(0)
+            app1 = input_.read(MAX_HEADER_SIZE), 0
+        else:
+            input_.seek(0)
+            app1 = find_app1(input_)
+
+    if not app1:
+        return {}
+
+    tiff, start = app1
+
+    try:
+        exif = parse_tiff(tiff)
+    except struct.error:
+        return {}
+
+    ifd1 = exif.get("ifd1", {})
+    offset = ifd1.get(THUMBNAIL_OFFSET)
+    length = ifd1.get(THUMBNAIL_LENGTH)
+    if offset and length and offset + length <= len(tiff):
+        exif["thumbnail"] = (start + offset, length)
+
+    return exif
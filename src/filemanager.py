@@ -1,20 +1,35 @@
 import os
 import copy
+import bisect
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
 
 from filefactory import FileFactory
 from filescanner import FileScanner
 from imagefile import EmptyImage
+from mover import Move, get_mover, is_same_device
+from duplicates import have_same_contents
 
 class Action:
     NORMAL = 0
     WARNING = 1
     DANGER = 2
 
-    def __init__(self, severity, description, undo):
+    def __init__(self, severity, description, undo, changes=None):
         self.severity = severity
         self.description = description
         self.undo = undo
 
+        # The changes made to the files, to be able to undo the action
+        # after a restart (see journal.py):
+        self.changes = changes or []
+        self.journal_id = None
+
+        # Whether the changes are still being made (by a background move),
+        # they are journaled once they are done:
+        self.pending = False
+
 # Decorator for methods to avoid executing its body
 # and perform the given action instead when the empty()
 # method of the classes returns True
@@ -31,14 +46,60 @@ def if_empty(action):
 def skip_if_empty(func):
     return if_empty(lambda: None)(func)
 
+# The files are indexed by their position in the full list (rank), and
+# both lists are kept ordered by rank. This way finding a file (by name),
+# inserting or removing are binary searches over the ranks instead of
+# linear searches comparing File objects.
 class FileList:
     def __init__(self):
         self.files = None
         self.actual = None
+        self.sort_keys = {}
+        self.orders = {}
+        self.filter_sets = None
+        self.unclassified = []
+        self.filter_state = None
 
     def set_files(self, files):
         self.files = files
         self.actual = copy.copy(files)
+        self.renumber()
+
+        # Sort keys (by sort name, then by id of the file) and the files
+        # sorted by them. The keys are computed once, and the orders are
+        # kept until the list changes:
+        self.sort_keys = {}
+        self.orders = {}
+
+        # Files (ids) by filetype and by status, and the state of the
+        # filter that produced the current filtered list:
+        self.filter_sets = None
+        self.unclassified = []
+        self.filter_state = None
+
+    # Drops everything known about a file that is removed or renamed:
+    def forget(self, file_):
+        for keys in self.sort_keys.values():
+            keys.pop(id(file_), None)
+        self.orders = {}
+
+        if self.filter_sets is not None:
+            for ids in self.filter_sets.values():
+                ids.discard(id(file_))
+
+    # Assigns the ranks again following the order of the full list:
+    def renumber(self):
+        self.file_ranks = list(map(float, range(len(self.files))))
+        self.ranks = {}   # filename -> rank
+        self.names = {}   # rank -> filename
+        self.removed = {} # filename -> rank (to put them back in place)
+
+        for rank, file_ in zip(self.file_ranks, self.files):
+            self.ranks[file_.get_filename()] = rank
+            self.names[rank] = file_.get_filename()
+
+        self.actual_ranks = [self.ranks[file_.get_filename()]
+                             for file_ in self.actual]
 
     def get_files(self):
         return self.actual
@@ -53,35 +114,282 @@ class FileList:
     def empty(self):
         return not self.actual
 
+    # The item is put back where it was if it was removed (otherwise it's
+    # placed before the item at the given position of the filtered list):
     def insert(self, pos, item):
-        self.files.insert(pos, item) # XXX may be misplaced
-        self.actual.insert(pos, item)
+        filename = item.get_filename()
+        rank = self.removed.pop(filename, None)
+
+        if rank is None or rank in self.names:
+            rank = self.get_rank_before(pos)
+
+        self.ranks[filename] = rank
+        self.names[rank] = filename
+        self.orders = {}
+        self.unclassified.append(item)
+
+        index = bisect.bisect_left(self.file_ranks, rank)
+        self.files.insert(index, item)
+        self.file_ranks.insert(index, rank)
+
+        index = bisect.bisect_left(self.actual_ranks, rank)
+        self.actual.insert(index, item)
+        self.actual_ranks.insert(index, rank)
+
+    def get_rank_before(self, pos):
+        if not self.files:
+            return 0.0
+
+        if pos < len(self.actual_ranks):
+            upper = self.actual_ranks[pos]
+        else:
+            upper = self.file_ranks[-1] + 1
+
+        index = bisect.bisect_left(self.file_ranks, upper)
+        lower = self.file_ranks[index - 1] if index > 0 else upper - 1
+
+        rank = (lower + upper) / 2
+        if not lower < rank < upper:
+            # Out of precision, start again:
+            self.renumber()
+            return self.get_rank_before(pos)
+
+        return rank
 
     def remove(self, pos):
-        del self.files[self.files.index(self.actual[pos].get_filename())]
+        rank = self.actual_ranks[pos]
         del self.actual[pos]
+        del self.actual_ranks[pos]
+
+        index = bisect.bisect_left(self.file_ranks, rank)
+        self.forget(self.files[index])
+        del self.files[index]
+        del self.file_ranks[index]
+
+        filename = self.names.pop(rank)
+        del self.ranks[filename]
+        self.removed[filename] = rank
+
+    # Removes many files (by name) at once, compacting the lists in a
+    # single pass. The files that aren't in the list are ignored:
+    def remove_files(self, filenames):
+        removed = set()
+        for filename in filenames:
+            rank = self.ranks.pop(filename, None)
+            if rank is not None:
+                del self.names[rank]
+                self.removed[filename] = rank
+                removed.add(rank)
+
+        kept, kept_ranks = [], []
+        for file_, rank in zip(self.files, self.file_ranks):
+            if rank in removed:
+                self.forget(file_)
+            else:
+                kept.append(file_)
+                kept_ranks.append(rank)
+        self.files, self.file_ranks = kept, kept_ranks
+
+        kept, kept_ranks = [], []
+        for file_, rank in zip(self.actual, self.actual_ranks):
+            if rank not in removed:
+                kept.append(file_)
+                kept_ranks.append(rank)
+        self.actual, self.actual_ranks = kept, kept_ranks
+
+    # Must be called when a file of the list is renamed:
+    def rename(self, filename, new_filename):
+        rank = self.ranks.pop(filename, None)
+        if rank is not None:
+            self.ranks[new_filename] = rank
+            self.names[rank] = new_filename
+            file_ = self.files[bisect.bisect_left(self.file_ranks, rank)]
+            self.forget(file_)
+            self.unclassified.append(file_)
 
     def find(self, filename):
+        index = self.lookup(filename)
+        if index is not None:
+            return index
+
+        # Not indexed (or filtered out):
         return self.actual.index(filename)
 
-    def sort(self, key, reverse):
-        self.files = sorted(self.files, key=key, reverse=reverse)
-        self.actual = sorted(self.actual, key=key, reverse=reverse)
+    # Returns the position of the file in the filtered list (None if it's
+    # not there):
+    def lookup(self, filename):
+        rank = self.ranks.get(filename)
+        if rank is not None:
+            index = bisect.bisect_left(self.actual_ranks, rank)
+            if index < len(self.actual_ranks) and self.actual_ranks[index] == rank:
+                return index
+        return None
+
+    def contains(self, filename):
+        return filename in self.ranks
+
+    # Whether the file was removed from this list (and not put back):
+    def was_removed(self, filename):
+        return filename in self.removed
+
+    def has_sort_keys(self, name):
+        keys = self.sort_keys.get(name, {})
+        return name in self.orders or all(id(file_) in keys for file_ in self.files)
+
+    # Whether this very file (not just its name) is in the list:
+    def contains_file(self, file_):
+        rank = self.ranks.get(file_.get_filename())
+        if rank is None:
+            return False
+        index = bisect.bisect_left(self.file_ranks, rank)
+        return index < len(self.files) and self.files[index] is file_
+
+    # Computes the missing keys (in parallel if they need I/O) yielding
+    # the progress. The list may change meanwhile: the keys of the files
+    # removed since then are dropped (their ids could be reused):
+    def compute_sort_keys(self, name, key, parallel):
+        keys = self.sort_keys.setdefault(name, {})
+        missing = [file_ for file_ in self.files if id(file_) not in keys]
+        total = float(len(missing))
+
+        if not parallel:
+            for index, file_ in enumerate(missing):
+                value = key(file_)
+                if self.contains_file(file_):
+                    keys[id(file_)] = value
+                yield index / total
+            return
+
+        pool = ThreadPool(multiprocessing.cpu_count())
+        try:
+            results = pool.imap_unordered(lambda file_: (file_, key(file_)),
+                                          missing, 16)
+            for index, (file_, value) in enumerate(results):
+                if self.contains_file(file_):
+                    keys[id(file_)] = value
+                yield index / total
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_sort_keys(self, name, key, parallel):
+        for progress in self.compute_sort_keys(name, key, parallel):
+            pass
+        return self.sort_keys[name]
+
+    def sort(self, name, key, reverse, parallel=False):
+        if name not in self.orders:
+            keys = self.get_sort_keys(name, key, parallel)
+            self.orders[name] = sorted(self.files,
+                                       key=lambda file_: keys[id(file_)])
+
+        order = self.orders[name]
+        self.files = order[::-1] if reverse else list(order)
+
+        # The filtered list keeps the same files, in the new order:
+        visible = set(map(id, self.actual))
+        self.actual = [file_ for file_ in self.files if id(file_) in visible]
+        self.renumber()
+
+    def classify(self, filter_, files):
+        for file_ in files:
+            filetype = filter_.get_filetype(file_.get_filename())
+            if filetype:
+                self.filter_sets.setdefault(filetype, set()).add(id(file_))
+            self.filter_sets.setdefault(filter_.get_status(file_), set()).add(id(file_))
+
+    def get_filter_sets(self, filter_):
+        if self.filter_sets is None:
+            self.filter_sets = {}
+            self.classify(filter_, self.files)
+        else:
+            self.classify(filter_, self.unclassified)
+        self.unclassified = []
+        return self.filter_sets
 
+    # The filetypes and status are set operations, only the pattern needs
+    # to be evaluated file by file. If the filter got narrower, only the
+    # files of the current filtered list are evaluated:
     def apply_filter(self, filter_):
+        sets = self.get_filter_sets(filter_)
+        by_filetype = set().union(*[sets.get(filetype, ())
+                                    for filetype in filter_.allowed_filetypes])
+        by_status = set().union(*[sets.get(status, ())
+                                  for status in filter_.allowed_status])
+        allowed = by_filetype & by_status
+
+        if self.filter_state and filter_.is_narrower(self.filter_state):
+            candidates = list(zip(self.actual, self.actual_ranks))
+        else:
+            candidates = list(zip(self.files, self.file_ranks))
+
         self.actual = []
+        self.actual_ranks = []
+        total = float(len(candidates))
+        for index, (file_, rank) in enumerate(candidates):
+            if filter_.pattern:
+                yield index / total
+            if (id(file_) in allowed and
+                filter_.matches_pattern(file_.get_filename())):
+                self.actual.append(file_)
+                self.actual_ranks.append(rank)
+
+        self.filter_state = filter_.get_state()
+
+# Trashes (or moves, if there's a target directory) a set of files. The I/O
+# is done by the run generator (to be run by an Updater), and then the
+# file manager compacts the list once (see FileManager.finish_batch):
+class BatchOperation:
+    def __init__(self, files, target_dir=None, is_taken=os.path.isfile):
+        self.files = files
+        self.target_dir = target_dir
+        self.is_taken = is_taken
+        self.done = [] # (file, original filename)
+        self.renamed = 0
+
+    # This is done in a separate thread:
+    def run(self):
         total = float(len(self.files))
         for index, file_ in enumerate(self.files):
             yield index / total
-            if filter_.allowed(file_):
-                self.actual.append(file_)
+            orig_filename = file_.get_filename()
+            try:
+                if self.target_dir:
+                    file_.rename(self.get_target(file_))
+                else:
+                    file_.trash()
+                self.done.append((file_, orig_filename))
+            except Exception as e:
+                print("Warning:", e)
+
+    # Files already in the target directory are not overwritten:
+    def get_target(self, file_):
+        candidate = get_safe_candidate(self.target_dir, file_.get_filename(),
+                                       self.is_taken)
+        if candidate != file_.get_basename():
+            self.renamed += 1
+        return os.path.join(self.target_dir, candidate)
+
+def get_safe_candidate(target, filename, is_taken=os.path.isfile):
+    candidate = os.path.basename(filename)
+
+    index = 0
+    while is_taken(os.path.join(target, candidate)):
+        name = os.path.basename(''.join(filename.split('.')[:-1]))
+        ext = filename.split('.')[-1]
+        index += 1
+        candidate = "%s (%d).%s" % (name, index, ext)
+
+    return candidate
 
 class FileManager:
-    def __init__(self, on_list_modified=lambda: None):
+    def __init__(self, on_list_modified=lambda: None,
+                       on_action_done=lambda action: None):
         self.filelist = FileList()
         self.index = 0
 
         self.on_list_modified = on_list_modified
+        self.on_action_done = on_action_done
 
     def set_files(self, files):
         self.filelist.set_files(list(map(FileFactory.create, files)))
@@ -98,6 +406,9 @@ class FileManager:
     def get_next_file(self):
         return self.filelist.get_item_at(self.index + 1)
 
+    def get_file_at_offset(self, offset):
+        return self.filelist.get_item_at(self.index + offset)
+
     @if_empty(lambda: -1)
     def get_current_index(self):
         return self.index
@@ -137,33 +448,73 @@ class FileManager:
         self.index = max(min(index,self.filelist.get_length()-1), 0)
         self.on_list_modified()
 
+    def is_listed(self, filename):
+        return self.filelist.lookup(filename) is not None
+
+    # Returns the file of the list with that name (None if not listed):
+    def get_listed_file(self, filename):
+        index = self.filelist.lookup(filename)
+        if index is None:
+            return None
+        return self.filelist.get_item_at(index)
+
     @skip_if_empty
     def go_file(self, filename):
         self.index = self.filelist.find(filename)
         self.on_list_modified()
 
+    # Fills the missing stats of the files, one directory at a time:
+    def fill_stats(self):
+        pending = {}
+        for file_ in self.filelist.files:
+            if file_.stat is None:
+                pending.setdefault(file_.get_dirname(), []).append(file_)
+
+        scanner = FileScanner()
+        for dirname, files in pending.items():
+            stats = scanner.get_stats_from_dir(dirname or ".")
+            for file_ in files:
+                path = os.path.join(dirname or ".", file_.get_basename())
+                if path in stats:
+                    file_.set_stat(stats[path])
+
+    # The keys are plain values (not the Datetime, Size... objects) so
+    # they are cheap to keep and compare:
     def sort_by_date(self, reverse):
-        filename = self.get_current_file().get_filename()
-        self.filelist.sort(key=lambda file_: file_.get_mtime(),
-                           reverse=reverse)
-        self.go_file(filename)
+        self.fill_stats()
+        self.sort("date", lambda file_: file_.get_stat().st_mtime, reverse)
 
     def sort_by_name(self, reverse):
-        filename = self.get_current_file().get_filename()
-        self.filelist.sort(key=lambda file_: file_.get_filename(),
-                           reverse=reverse)
-        self.go_file(filename)
+        self.sort("name", lambda file_: file_.get_filename(), reverse)
 
     def sort_by_size(self, reverse):
-        filename = self.get_current_file().get_filename()
-        self.filelist.sort(key=lambda file_: file_.get_filesize(),
-                           reverse=reverse)
-        self.go_file(filename)
+        self.fill_stats()
+        self.sort("size", lambda file_: file_.get_stat().st_size, reverse)
 
     def sort_by_dimensions(self, reverse):
+        self.sort("dimensions", self.get_area, reverse, parallel=True)
+
+    # The dimensions are read from the headers when possible, but it's
+    # still slow for big lists. This generator reads them (it's meant to
+    # be run by an Updater), and then sort_by_dimensions is immediate:
+    def read_dimensions(self):
+        return self.filelist.compute_sort_keys("dimensions", self.get_area, True)
+
+    def has_dimensions(self):
+        return self.filelist.has_sort_keys("dimensions")
+
+    # Unreadable files are sorted first (instead of failing the sort):
+    def get_area(self, file_):
+        try:
+            dimensions = file_.get_dimensions()
+            return dimensions.get_width() * dimensions.get_height()
+        except Exception as e:
+            print("Warning:", e)
+            return 0
+
+    def sort(self, name, key, reverse, parallel=False):
         filename = self.get_current_file().get_filename()
-        self.filelist.sort(key=lambda file_: file_.get_dimensions(),
-                           reverse=reverse)
+        self.filelist.sort(name, key, reverse, parallel)
         self.go_file(filename)
 
     def on_dir_changed(self, dirname):
@@ -183,10 +534,12 @@ class FileManager:
         self.on_dir_changed(orig_dirname)
 
         if os.path.abspath(orig_dirname) == os.path.abspath(current.get_dirname()):
+            self.filelist.rename(orig_filename, new_filename)
             self.on_list_modified()
 
             def undo_action():
                 current.rename(orig_filename)
+                self.filelist.rename(new_filename, orig_filename)
                 self.on_dir_changed(orig_dirname)
                 self.go_file(orig_filename)
         else:
@@ -203,7 +556,8 @@ class FileManager:
 
         return Action(Action.NORMAL,
                       "'%s' renamed to '%s'" % (orig_filename, new_filename),
-                      undo_action)
+                      undo_action,
+                      [["move", orig_filename, new_filename]])
 
     @skip_if_empty
     def copy_current(self, target_dir, target_name=''):
@@ -230,7 +584,8 @@ class FileManager:
 
         return Action(Action.NORMAL,
                       "'%s' copied to '%s'" % (orig_filename, target_dir),
-                      undo_action)
+                      undo_action,
+                      [["copy", orig_filename, new_filename]])
 
     @skip_if_empty
     def move_current(self, target_dir, target_name=''):
@@ -247,6 +602,13 @@ class FileManager:
         if os.path.isfile(new_filename):
             return self.handle_duplicate_move(target_dir, target_name)
 
+        # Its contents can't be compared until that move is finished:
+        if get_mover().is_pending_target(new_filename):
+            return self.move_current_renamed(target_dir)
+
+        if not is_same_device(orig_filename, target_dir):
+            return self.move_current_async(target_dir, new_filename)
+
         current.rename(new_filename)
         self.on_dir_changed(orig_dirname)
         self.on_dir_changed(target_dir)
@@ -262,7 +624,63 @@ class FileManager:
 
         return Action(Action.NORMAL,
                       "'%s' moved to '%s'" % (orig_filename, target_dir),
-                      undo_action)
+                      undo_action,
+                      [["move", orig_filename, new_filename]])
+
+    # The file is copied to the other device by the I/O thread, and it's
+    # removed from the list right away (it's put back if the move fails):
+    def move_current_async(self, target_dir, new_filename):
+        current = self.get_current_file()
+        orig_index = self.get_current_index()
+        orig_dirname = current.get_dirname()
+        orig_filename = current.get_filename()
+
+        def on_moved(move):
+            if move.state == Move.DONE:
+                current.metadata_cache.move(orig_filename, new_filename)
+                self.on_dir_changed(orig_dirname)
+                self.on_dir_changed(target_dir)
+                action.pending = False
+                self.on_action_done(action)
+            elif move.state == Move.FAILED:
+                # Unless another list has been loaded meanwhile:
+                if self.filelist.was_removed(orig_filename):
+                    self.filelist.insert(orig_index, current)
+                    self.on_list_modified()
+
+        move = Move(orig_filename, new_filename, on_moved)
+        get_mover().push(move)
+        self.on_current_eliminated()
+
+        def on_restored(move):
+            if move.state == Move.DONE:
+                self.on_dir_changed(orig_dirname)
+                self.on_dir_changed(target_dir)
+                self.filelist.insert(orig_index, FileFactory.create(orig_filename))
+                self.go_file(orig_filename)
+
+        def undo_action():
+            if move.cancel():
+                # Not moved yet, the file is still in place:
+                self.filelist.insert(orig_index, current)
+                self.go_file(orig_filename)
+            elif move.state != Move.FAILED:
+                get_mover().push(Move(new_filename, orig_filename, on_restored))
+
+        action = Action(Action.NORMAL,
+                        "'%s' moved to '%s'" % (orig_filename, target_dir),
+                        undo_action,
+                        [["move", orig_filename, new_filename]])
+        action.pending = True
+        return action
+
+    def move_current_renamed(self, target_dir):
+        orig_filename = self.get_current_file().get_filename()
+        candidate = self.get_safe_candidate(target_dir)
+        action = self.move_current(target_dir, candidate)
+        action.severity = Action.WARNING
+        action.description = "'%s' auto-renamed to '%s' in '%s'" % (orig_filename, candidate, target_dir)
+        return action
 
     @skip_if_empty
     def delete_current(self):
@@ -284,19 +702,128 @@ class FileManager:
 
         return Action(Action.DANGER,
                       "'%s' deleted" % (orig_filename),
-                      undo_action)
+                      undo_action,
+                      [["trash", orig_filename]])
 
-    @skip_if_empty
+    # Returns a batch operation for the files in the given range (run it,
+    # and then pass it to finish_batch):
     def mass_delete(self, initial, final):
-        for index in range(initial, final+1):
-            self.filelist.get_item_at(initial).trash()
-            self.filelist.remove(initial)
-            progress = float(index-initial) / ((final+1) - initial)
-            yield progress
+        return BatchOperation(self.filelist.get_files()[initial:final+1])
+
+    def mass_move(self, initial, final, target_dir):
+        return BatchOperation(self.filelist.get_files()[initial:final+1],
+                              target_dir, self.is_taken)
+
+    def delete_files(self, files):
+        return BatchOperation(files)
 
-        self.index = min(self.filelist.get_length()-1, self.index)
+    # This is requested to be done by the main thread:
+    def finish_batch(self, batch):
+        if not batch.done:
+            return None
+
+        current = self.get_current_file()
+        files = [file_ for file_, _ in batch.done]
+        orig_filenames = [orig_filename for _, orig_filename in batch.done]
+        orig_dirnames = set(map(os.path.dirname, orig_filenames))
+
+        # The batch may include files that aren't in the list (e.g. the
+        # duplicates found in a directory tree):
+        listed = set(filter(self.filelist.contains, orig_filenames))
+        positions = [index for index in map(self.filelist.lookup, orig_filenames)
+                           if index is not None]
+        first_index = min(positions) if positions else self.index
+
+        self.filelist.remove_files(orig_filenames)
+
+        for dirname in orig_dirnames:
+            self.on_dir_changed(dirname)
+        if batch.target_dir:
+            self.on_dir_changed(batch.target_dir)
+
+        if (id(current) in set(map(id, files)) or
+            current.get_filename() in listed):
+            self.index = min(first_index, max(self.filelist.get_length() - 1, 0))
+        else:
+            self.index = self.filelist.find(current.get_filename())
         self.on_list_modified()
 
+        def undo_action():
+            for file_, orig_filename in batch.done:
+                if batch.target_dir:
+                    restored = FileFactory.create(file_.get_filename())
+                    restored.rename(orig_filename)
+                else:
+                    restored = FileFactory.create(orig_filename)
+                    restored.untrash()
+                if orig_filename in listed:
+                    self.filelist.insert(first_index, restored)
+
+            for dirname in orig_dirnames:
+                self.on_dir_changed(dirname)
+            if batch.target_dir:
+                self.on_dir_changed(batch.target_dir)
+
+            restored = [f for f in orig_filenames if f in listed]
+            if restored:
+                self.go_file(restored[0])
+            else:
+                self.on_list_modified()
+
+        if batch.target_dir:
+            severity = Action.WARNING if batch.renamed else Action.NORMAL
+            description = "%d files moved to '%s'" % (len(files), batch.target_dir)
+            if batch.renamed:
+                description += " (%d auto-renamed)" % batch.renamed
+            changes = [["move", orig_filename, file_.get_filename()]
+                       for file_, orig_filename in batch.done]
+        else:
+            severity = Action.DANGER
+            description = "%d files deleted" % len(files)
+            changes = [["trash", orig_filename] for orig_filename in orig_filenames]
+
+        return Action(severity, description, undo_action, changes)
+
+    # Actions of a previous session (from the journal). Only their changes
+    # to the files can be undone, and the files restored are added to the
+    # list:
+    def get_journaled_action(self, severity, description, changes):
+        def undo_action():
+            gone, restored = [], []
+
+            for change in reversed(changes):
+                try:
+                    if change[0] == "move":
+                        source, target = change[1:]
+                        if os.path.exists(source):
+                            raise IOError("'%s' already exists" % source)
+                        FileFactory.create(target).rename(source)
+                        gone.append(target)
+                        restored.append(source)
+                    elif change[0] == "copy":
+                        FileFactory.create(change[2]).trash()
+                        gone.append(change[2])
+                    elif change[0] == "trash":
+                        FileFactory.create(change[1]).untrash()
+                        restored.append(change[1])
+                except Exception as e:
+                    print("Warning:", e)
+
+            for filename in gone + restored:
+                self.on_dir_changed(os.path.dirname(filename))
+
+            self.filelist.remove_files(gone)
+            self.index = min(self.index, max(self.filelist.get_length() - 1, 0))
+            for filename in restored:
+                self.filelist.insert(self.index, FileFactory.create(filename))
+
+            if restored:
+                self.go_file(restored[-1])
+            else:
+                self.on_list_modified()
+
+        return Action(severity, description, undo_action, changes)
+
     @skip_if_empty
     def toggle_star(self):
         current = self.get_current_file()
@@ -304,17 +831,21 @@ class FileManager:
         orig_filename = current.get_filename()
         prev_status = current.is_starred()
         current.set_starred(not prev_status)
+        self.filelist.rename(orig_filename, current.get_filename())
         self.on_dir_changed(orig_dirname)
         self.on_list_modified()
 
         def undo_action():
+            starred_filename = current.get_filename()
             current.set_starred(prev_status)
+            self.filelist.rename(starred_filename, current.get_filename())
             self.on_dir_changed(orig_dirname)
             self.go_file(orig_filename)
 
         return Action(Action.NORMAL,
                       "'%s' %s" % (current.get_basename(), "unstarred" if prev_status else "starred"),
-                      undo_action)
+                      undo_action,
+                      [["move", orig_filename, current.get_filename()]])
 
     def apply_filter(self, filter_):
         current = self.get_current_file()
@@ -332,24 +863,19 @@ class FileManager:
 
     # Internal helpers:
     def get_safe_candidate(self, target):
-        filename = self.get_current_file().get_filename()
-        candidate = os.path.basename(filename)
+        return get_safe_candidate(target, self.get_current_file().get_filename(),
+                                  self.is_taken)
 
-        index = 0
-        while os.path.isfile(os.path.join(target, candidate)):
-            name = os.path.basename(''.join(filename.split('.')[:-1]))
-            ext = filename.split('.')[-1]
-            index += 1
-            candidate = "%s (%d).%s" % (name, index, ext)
-
-        return candidate
+    # Whether the filename exists or a file is being moved there:
+    def is_taken(self, filename):
+        return os.path.isfile(filename) or get_mover().is_pending_target(filename)
 
     def handle_duplicate_copy(self, target_dir, target_name):
         current = self.get_current_file()
         orig_filename = current.get_filename()
-        new_file = FileFactory.create(os.path.join(target_dir, target_name))
+        new_filename = os.path.join(target_dir, target_name)
 
-        if current.get_sha1() == new_file.get_sha1():
+        if have_same_contents(orig_filename, new_filename):
             self.on_list_modified()
             return Action(Action.NORMAL,
                           "'%s' skipped to avoid duplicates" % orig_filename,
@@ -364,18 +890,21 @@ class FileManager:
     def handle_duplicate_move(self, target_dir, target_name):
         current = self.get_current_file()
         orig_filename = current.get_filename()
-        new_file = FileFactory.create(os.path.join(target_dir, target_name))
+        new_filename = os.path.join(target_dir, target_name)
+
+        # Not a duplicate, the same file (e.g. moved to its own directory):
+        if os.path.samefile(orig_filename, new_filename):
+            self.on_list_modified()
+            return Action(Action.NORMAL,
+                          "'%s' is already in '%s'" % (orig_filename, target_dir),
+                          lambda: None)
 
-        if current.get_sha1() == new_file.get_sha1():
+        if have_same_contents(orig_filename, new_filename):
             action = self.delete_current()
             action.description = "'%s' deleted to avoid duplicates" % orig_filename
             return action
         else:
-            candidate = self.get_safe_candidate(target_dir)
-            action = self.move_current(target_dir, candidate)
-            action.severity = Action.WARNING
-            action.description = "'%s' auto-renamed to '%s' in '%s'" % (orig_filename, candidate, target_dir)
-            return action
+            return self.move_current_renamed(target_dir)
 
     def on_current_eliminated(self):
         self.filelist.remove(self.index)
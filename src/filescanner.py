@@ -4,6 +4,14 @@ import re
 
 import gtk
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from videofile import VideoFile
 from giffile import GIFFile
 from pdffile import PDFFile
@@ -15,6 +23,7 @@ from cache import Cache, cached
 class FileFilter:
     STARRED   = "starred"
     UNSTARRED = "unstarred"
+    REGEX_CHARS = set(".^$*+?{}[]\\|()")
 
     def __init__(self):
         self.allowed_filetypes = set(FileFilter.get_valid_filetypes())
@@ -70,6 +79,42 @@ class FileFilter:
 
         return ret
 
+    # The state can be kept to find out later if the filter got narrower:
+    def get_state(self):
+        return (frozenset(self.allowed_filetypes),
+                frozenset(self.allowed_status),
+                self.pattern)
+
+    # Whether the files allowed now are a subset of the ones allowed in the
+    # given state (a literal pattern is narrower if it contains the
+    # previous one):
+    def is_narrower(self, state):
+        filetypes, status, pattern = state
+
+        if not (self.allowed_filetypes <= filetypes and
+                self.allowed_status <= status):
+            return False
+
+        if not pattern or pattern == self.pattern:
+            return True
+
+        return (self.is_literal(pattern) and self.is_literal(self.pattern) and
+                pattern.lower() in self.pattern.lower())
+
+    def is_literal(self, pattern):
+        return not (set(pattern) & self.REGEX_CHARS)
+
+    def get_filetype(self, filename):
+        for filetype, extensions in self.get_valid_extensions().items():
+            for extension in extensions:
+                if filename.lower().endswith("." + extension):
+                    return filetype
+
+        return None
+
+    def get_status(self, file_):
+        return self.STARRED if file_.is_starred() else self.UNSTARRED
+
     def has_allowed_ext(self, filename):
         valid_extensions = self.get_valid_extensions()
 
@@ -130,6 +175,24 @@ class FileScanner:
 
         return sorted(files)
 
+    # Returns the stat of every entry in the directory, using a single
+    # scandir pass when available:
+    def get_stats_from_dir(self, directory):
+        stats = {}
+
+        try:
+            if scandir:
+                for entry in scandir(directory):
+                    stats[entry.path] = entry.stat()
+            else:
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    stats[path] = os.stat(path)
+        except OSError as e:
+            print("Warning:", e)
+
+        return stats
+
     def get_files_from_filename(self, filename):
         return self.get_files_from_dir(os.path.dirname(filename))
 
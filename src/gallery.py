@@ -4,16 +4,17 @@ import os
 import gtk
 import gobject
 
-from imagefile import GTKIconImage
+from imagefile import Size, GTKIconImage
 from filescanner import FileScanner
 from filemanager import FileManager
 
 from thumbnail import DirectoryThumbnail
-from dialogs import NewFolderDialog, ProgressBarDialog
+from dialogs import (NewFolderDialog, ProgressBarDialog, ErrorDialog,
+                     QuestionDialog)
 
 from cache import Cache, cached
 from system import execute
-from threads import Worker, Updater
+from threads import Updater, get_scheduler, PRIORITY_GALLERY
 
 class GalleryItem:
     def __init__(self, item, size):
@@ -42,7 +43,7 @@ class ImageItem(GalleryItem):
     @cached()
     def final_data(self):
         width, height = self.item.get_dimensions_to_fit(self.size, self.size)
-        return (self.item.get_pixbuf_at_size(width, height),
+        return (self.item.get_thumbnail_at_size(width, height),
                 "%s\n<span size='small'>%s\n%s</span>" % \
                     (self.item.get_basename(),
                      self.item.get_dimensions(),
@@ -86,6 +87,7 @@ class SelectorListStoreBuilder:
 
         self.items = []
         self.liststore = gtk.ListStore(gtk.gdk.Pixbuf, str, str)
+        self.loaded = set() # indices of the rows with their final data
         self.items_count = (None, None)
 
     def get_items_from_dir(self):
@@ -121,7 +123,8 @@ class SelectorListStoreBuilder:
 
         # Try to (manually) get the values from the cache:
         try:
-            self.items, self.liststore, self.items_count = self.liststore_cache[key]
+            (self.items, self.liststore,
+             self.loaded, self.items_count) = self.liststore_cache[key]
             return
         except KeyError:
             pass
@@ -139,7 +142,102 @@ class SelectorListStoreBuilder:
             yield float(index) / total
 
         # Update the cache with the generated lists:
-        self.liststore_cache[key] = self.items, self.liststore, self.items_count
+        self.liststore_cache[key] = (self.items, self.liststore,
+                                     self.loaded, self.items_count)
+
+# Loads the final data of the items of a gallery, but only for the rows in
+# the viewport of its iconview and a few rows around it (the ones likely to
+# be shown next), so a directory with thousands of images only decodes the
+# dozens that are shown. The pending loads are scheduled again, the visible
+# rows first, every time the view is scrolled or resized.
+class VisibleItemsLoader:
+    MARGIN_ROWS = 2  # rows loaded ahead, above and below the viewport
+    INITIAL_ROWS = 4 # rows loaded if the iconview isn't laid out yet
+
+    def __init__(self, iconview, scrolled):
+        self.iconview = iconview
+        # The items are independent, they can be loaded in parallel:
+        self.queue = get_scheduler().get_queue(PRIORITY_GALLERY, serial=False)
+
+        self.liststore = None
+        self.items = []
+        self.loaded = set()
+        self.loading = set() # rows being decoded by a worker
+        self.pending = False
+
+        adjustment = scrolled.get_vadjustment()
+        adjustment.connect("value-changed", self.on_view_changed)
+        adjustment.connect("changed", self.on_view_changed)
+
+    def set_model(self, liststore, items, loaded):
+        self.liststore = liststore
+        self.items = items
+        self.loaded = loaded
+        self.loading = set()
+        self.on_view_changed()
+
+    def clear(self):
+        self.queue.clear()
+        self.liststore = None
+        self.items = []
+
+    # Scrolling emits lots of signals, the loads are only scheduled once
+    # the main loop is idle (so the iconview layout is also up to date):
+    def on_view_changed(self, *args):
+        if not self.pending:
+            self.pending = True
+            gobject.idle_add(self.schedule)
+
+    def schedule(self):
+        self.pending = False
+        self.queue.clear()
+
+        for index in self.get_wanted_indices():
+            if index not in self.loaded and index not in self.loading:
+                self.queue.push((self.load_item,
+                                 (self.liststore, self.loaded, self.loading,
+                                  index, self.items[index])))
+
+    # The visible rows first, then the ones below and above them:
+    def get_wanted_indices(self):
+        total = len(self.items)
+        if not total:
+            return []
+
+        columns = max(self.iconview.get_columns(), 1)
+        visible = self.iconview.get_visible_range()
+        if visible:
+            (first,), (last,) = visible
+        else:
+            first, last = 0, min(self.INITIAL_ROWS * columns, total) - 1
+
+        margin = self.MARGIN_ROWS * columns
+        return (list(range(first, last + 1)) +
+                list(range(last + 1, min(last + 1 + margin, total))) +
+                list(reversed(range(max(first - margin, 0), first))))
+
+    # This is done in a separate thread. The row is marked when the load
+    # starts, since the ones still queued are cleared on every scroll. The
+    # sets are the ones of the model the job was queued for, set_model
+    # replaces them instead of changing them:
+    def load_item(self, liststore, loaded, loading, index, item):
+        loading.add(index)
+        try:
+            data = item.final_data()
+        except Exception:
+            # It's tried again the next time it's scheduled:
+            loading.discard(index)
+            raise
+        return (self.update_store_entry, (liststore, loaded, loading, index, data))
+
+    # This is requested to be done by the main thread:
+    def update_store_entry(self, liststore, loaded, loading, index, data):
+        iter_ = liststore.get_iter((index,))
+        liststore.set_value(iter_, 0, data[0])
+        liststore.set_value(iter_, 1, data[1])
+        liststore.set_value(iter_, 2, data[2])
+        loaded.add(index)
+        loading.discard(index)
 
 class GallerySelector:
     def __init__(self, title, parent, dirname, last_targets, on_file_selected, on_dir_selected,
@@ -285,7 +383,7 @@ class GallerySelector:
 
         scrolled = gtk.ScrolledWindow()
         scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
-        scrolled.add_with_viewport(self.iconview)
+        scrolled.add(self.iconview)
         scrolled.set_size_request(int((thumb_size * 1.06) * columns), height)
 
         vbox.pack_start(scrolled, True, True, 0)
@@ -318,8 +416,7 @@ class GallerySelector:
         settings.props.gtk_button_images = True
 
         # Data initialization:
-        self.loader = Worker()
-        self.loader.start()
+        self.loader = VisibleItemsLoader(self.iconview, scrolled)
 
         self.curdir = os.path.realpath(os.path.expanduser(dirname))
         self.last_filter = ""
@@ -345,32 +442,17 @@ class GallerySelector:
         dialog.destroy()
         self.loader.clear()
 
-        for index, item in enumerate(builder.items):
-            # Schedule an update on this item:
-            self.loader.push((self.update_item_thumbnail,
-                             (builder.liststore, index, item)))
-
         # Update the items list:
         self.items = builder.items
         # Associate the new liststore to the iconview:
         self.iconview.set_model(builder.liststore)
+        # Schedule the update of the visible items:
+        self.loader.set_model(builder.liststore, builder.items, builder.loaded)
         # Update the curdir entry widget:
         self.location_entry.set_text(self.curdir)
         # Update directory information:
         self.info_label.set_text("%d dirs, %d files" % builder.items_count)
 
-    # This is done in a separate thread:
-    def update_item_thumbnail(self, liststore, index, item):
-        data = item.final_data()
-        return (self.update_store_entry, (liststore, index, data))
-
-    # This is requested to be done by the main thread:
-    def update_store_entry(self, liststore, index, data):
-        iter_ = liststore.get_iter((index,))
-        liststore.set_value(iter_, 0, data[0])
-        liststore.set_value(iter_, 1, data[1])
-        liststore.set_value(iter_, 2, data[2])
-
     def on_key_press_event(self, widget, event, data=None):
         key_name = gtk.gdk.keyval_name(event.keyval)
         #print "gallery - key pressed:", key_name
@@ -478,8 +560,7 @@ class GallerySelector:
         self.close()
 
     def close(self):
-        self.loader.stop()
-        self.loader.join()
+        self.loader.clear()
         # This is to avoid invoking self.window.destroy() directly, it
         # was causing a SIGSEGV after the on_cursor_changed handler ran
         # (https://mail.gnome.org/archives/gtk-app-devel-list/2004-September/msg00230.html)
@@ -492,10 +573,14 @@ class ViewerListStoreBuilder:
 
         self.items = []
         self.liststore = gtk.ListStore(gtk.gdk.Pixbuf, str, str)
+        self.loaded = set() # indices of the rows with their final data
+
+    def create_item(self, file_):
+        return ImageItem(file_, self.thumb_size/2)
 
     def build(self):
         for file_ in self.files:
-            self.items.append(ImageItem(file_, self.thumb_size/2))
+            self.items.append(self.create_item(file_))
             yield None # to pulse the progressbar
 
         total = len(self.items)
@@ -526,8 +611,8 @@ class GalleryViewer:
         self.window.add(hbox)
 
         # Right pane (location, iconview)
-        vbox = gtk.VBox(False, 5)
-        hbox.pack_start(vbox, True, True, 0)
+        self.vbox = gtk.VBox(False, 5)
+        hbox.pack_start(self.vbox, True, True, 0)
 
         # Iconview
         self.iconview = gtk.IconView()
@@ -542,14 +627,13 @@ class GalleryViewer:
 
         scrolled = gtk.ScrolledWindow()
         scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
-        scrolled.add_with_viewport(self.iconview)
+        scrolled.add(self.iconview)
         scrolled.set_size_request(int((thumb_size * 1.06) * columns), height)
 
-        vbox.pack_start(scrolled, True, True, 0)
+        self.vbox.pack_start(scrolled, True, True, 0)
 
         # Data initialization:
-        self.loader = Worker()
-        self.loader.start()
+        self.loader = VisibleItemsLoader(self.iconview, scrolled)
         self.files = files
         self.items = []
 
@@ -561,38 +645,26 @@ class GalleryViewer:
         dialog = ProgressBarDialog(self.window, "Loading...")
         dialog.show()
 
-        builder = ViewerListStoreBuilder(self.files, self.thumb_size)
+        builder = self.get_builder()
         updater = Updater(builder.build(),
                           dialog.update,
                           self.on_model_ready,
                           (builder, dialog))
         updater.start()
 
+    def get_builder(self):
+        return ViewerListStoreBuilder(self.files, self.thumb_size)
+
     def on_model_ready(self, builder, dialog):
         dialog.destroy()
         self.loader.clear()
 
-        for index, item in enumerate(builder.items):
-            # Schedule an update on this item:
-            self.loader.push((self.update_item_thumbnail,
-                             (builder.liststore, index, item)))
-
         # Update the items list:
         self.items = builder.items
         # Associate the new liststore to the iconview:
         self.iconview.set_model(builder.liststore)
-
-    # This is done in a separate thread:
-    def update_item_thumbnail(self, liststore, index, item):
-        data = item.final_data()
-        return (self.update_store_entry, (liststore, index, data))
-
-    # This is requested to be done by the main thread:
-    def update_store_entry(self, liststore, index, data):
-        iter_ = liststore.get_iter((index,))
-        liststore.set_value(iter_, 0, data[0])
-        liststore.set_value(iter_, 1, data[1])
-        liststore.set_value(iter_, 2, data[2])
+        # Schedule the update of the visible items:
+        self.loader.set_model(builder.liststore, builder.items, builder.loaded)
 
     def on_key_press_event(self, widget, event, data=None):
         key_name = gtk.gdk.keyval_name(event.keyval)
@@ -622,7 +694,117 @@ class GalleryViewer:
         self.close()
 
     def close(self):
-        self.loader.stop()
-        self.loader.join()
+        self.loader.clear()
         gobject.idle_add(lambda window: window.destroy(), self.window)
 
+
+class DuplicateItem(ImageItem):
+    def __init__(self, item, size, group):
+        ImageItem.__init__(self, item, size)
+        self.group = group
+        self.keep = False
+
+    def get_markup(self):
+        return "%s\n<span size='small'>Group %d, %s\n%s</span>" % \
+                   (self.item.get_basename(),
+                    self.group + 1,
+                    "<b>keep</b>" if self.keep else "trash",
+                    self.item.get_filesize())
+
+    def initial_data(self):
+        data = ImageItem.initial_data(self)
+        return (data[0], self.get_markup(), data[2])
+
+    def final_data(self):
+        data = ImageItem.final_data(self)
+        return (data[0], self.get_markup(), data[2])
+
+    def on_selected(self, gallery):
+        gallery.on_duplicate_selected(self)
+
+class DuplicatesListStoreBuilder(ViewerListStoreBuilder):
+    def __init__(self, groups, thumb_size):
+        ViewerListStoreBuilder.__init__(self, [], thumb_size)
+        self.groups = groups
+
+    def build(self):
+        # The first file of every group is kept by default:
+        for group, files in enumerate(self.groups):
+            for index, file_ in enumerate(files):
+                item = DuplicateItem(file_, self.thumb_size/2, group)
+                item.keep = (index == 0)
+                self.items.append(item)
+            yield None # to pulse the progressbar
+
+        total = len(self.items)
+        for index, item in enumerate(self.items):
+            self.liststore.append(item.initial_data())
+            yield float(index) / total
+
+# Shows the groups of duplicates found by a DuplicateFinder. Clicking on
+# a file toggles between keeping it and trashing it, and the callback
+# receives the files to trash.
+class DuplicatesViewer(GalleryViewer):
+    def __init__(self, parent, finder, callback, **kwargs):
+        GalleryViewer.__init__(self, title="Duplicates",
+                                     parent=parent,
+                                     files=[],
+                                     callback=callback,
+                                     **kwargs)
+        self.groups = finder.groups
+        self.window.set_title("Duplicates")
+
+        # Buttonbar
+        buttonbar = gtk.HBox(False, 0)
+
+        self.info_label = gtk.Label()
+        buttonbar.pack_start(self.info_label, False, False, 5)
+
+        button = gtk.Button("Trash unmarked")
+        button.set_image(gtk.image_new_from_stock(gtk.STOCK_DELETE,
+                                                  gtk.ICON_SIZE_BUTTON))
+        button.set_relief(gtk.RELIEF_NONE)
+        button.connect("clicked", self.on_trash_clicked)
+        buttonbar.pack_end(button, False, False, 5)
+
+        button = gtk.Button(stock=gtk.STOCK_CLOSE)
+        button.set_relief(gtk.RELIEF_NONE)
+        button.connect("clicked", lambda button: self.close())
+        buttonbar.pack_end(button, False, False, 0)
+
+        self.vbox.pack_start(buttonbar, False, False, 5)
+
+        self.info_label.set_text("%d groups, %s redundant" % \
+                                 (len(self.groups),
+                                  Size(finder.get_redundant_size())))
+
+    def get_builder(self):
+        return DuplicatesListStoreBuilder(self.groups, self.thumb_size)
+
+    def on_duplicate_selected(self, item):
+        item.keep = not item.keep
+
+        index = self.items.index(item)
+        liststore = self.iconview.get_model()
+        liststore.set_value(liststore.get_iter((index,)), 1, item.get_markup())
+
+    def on_trash_clicked(self, button):
+        kept = set(item.group for item in self.items if item.keep)
+        for group in range(len(self.groups)):
+            if group not in kept:
+                ErrorDialog(self.window,
+                            "Nothing would be kept from group %d" % (group + 1)).run()
+                return
+
+        files = [item.item for item in self.items if not item.keep]
+        if not files:
+            self.close()
+            return
+
+        dialog = QuestionDialog(self.window,
+                                "Are you sure you want to trash %d files?" % len(files))
+        if not dialog.run():
+            return
+
+        self.close()
+        self.callback(files)
@@ -20,11 +20,14 @@ class GIFFile(ImageFile):
     def set_anim_enabled(self, enabled):
         self.anim_enabled = enabled
 
-    def draw(self, widget, width, height):
+    def draw(self, widget, width, height, interp=gtk.gdk.INTERP_BILINEAR):
         if self.anim_enabled:
             widget.set_from_animation(self.get_pixbuf_anim_at_size(width, height))
         else:
-            widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height))
+            widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height, interp))
+
+    def can_be_refined(self):
+        return not self.anim_enabled
 
     @cached(pixbuf_anim_cache)
     def get_pixbuf_anim_at_size(self, width, height):
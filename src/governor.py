@@ -0,0 +1,59 @@
+# Memory governor (enabled with --soft-limit): it samples the RSS of the
+# process and, above the soft limit, it shrinks the caches in the given
+# order (the cheapest to rebuild first, the full decodes last) until the
+# excess is estimated to be freed. Above the hard limit, all the caches
+# are emptied.
+import gc
+
+from threading import Thread, Event
+
+from system import get_process_memory_usage
+from imagefile import Size
+
+class MemoryGovernor(Thread):
+    SOFT_FRACTION = 0.5 # of the entries of every cache shrunk above the soft limit
+
+    def __init__(self, caches, soft_limit, hard_limit, interval=2.0):
+        Thread.__init__(self)
+        self.daemon = True
+        self.caches = caches # list of (name, cache)
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                rss, _ = get_process_memory_usage()
+            except Exception as e:
+                print("Warning:", e)
+                return
+
+            if rss > self.hard_limit:
+                self.shrink(rss, 1.0, "hard", rss)
+            elif rss > self.soft_limit:
+                self.shrink(rss, self.SOFT_FRACTION, "soft", rss - self.soft_limit)
+
+    def shrink(self, rss, fraction, limit, excess):
+        freed = []
+        total = 0
+
+        for name, cache in self.caches:
+            entries, size = cache.shrink(fraction)
+            if entries:
+                freed.append("%s: %d entries (%s)" % (name, entries, Size(size)))
+                total += size
+            # The size of the entries of some caches is unknown, so they
+            # are only known to be enough if there are sizes:
+            if total >= excess:
+                break
+
+        gc.collect()
+
+        if freed:
+            print("Memory: RSS %s over the %s limit, freed %s" %
+                  (Size(rss), limit, ", ".join(freed)))
+
+    def stop(self):
+        self.stopped.set()
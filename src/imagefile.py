@@ -9,8 +9,13 @@ import gtk
 from PIL import Image as PILImage
 from PIL.ExifTags import TAGS as PILExifTags
 
-from cache import Cache, cached
+from cache import Cache, PersistentCache, cached
 from system import trash, untrash, external_open
+from exif import read_exif, has_exif, ORIENTATION
+from latency import tracker
+
+import decoder
+import phash
 
 class ImageDimensions:
     def __init__(self, width, height):
@@ -59,6 +64,7 @@ class File:
 
     def __init__(self, filename):
         self.filename = filename
+        self.stat = None
 
     def get_filename(self):
         return self.filename
@@ -69,10 +75,21 @@ class File:
     def get_basename(self):
         return os.path.basename(self.filename)
 
+    # The stat is obtained once and shared by all the metadata getters,
+    # it can also be filled in bulk (see FileManager.fill_stats):
+    def get_stat(self):
+        if self.stat is None:
+            self.stat = os.stat(self.filename)
+        return self.stat
+
+    def set_stat(self, stat):
+        self.stat = stat
+
+    def invalidate_stat(self):
+        self.stat = None
+
     def get_filesize(self):
-        stat = os.stat(self.filename)
-        size = stat.st_size
-        return Size(size)
+        return Size(self.get_stat().st_size)
 
     @cached()
     def get_sha1(self):
@@ -80,13 +97,13 @@ class File:
             return hashlib.sha1(input_.read()).hexdigest()
 
     def get_atime(self):
-        return Datetime(os.stat(self.filename).st_atime)
+        return Datetime(self.get_stat().st_atime)
 
     def get_mtime(self):
-        return Datetime(os.stat(self.filename).st_mtime)
+        return Datetime(self.get_stat().st_mtime)
 
     def get_ctime(self):
-        return Datetime(os.stat(self.filename).st_ctime)
+        return Datetime(self.get_stat().st_ctime)
 
     def __hash__(self):
         return hash(self.filename)
@@ -105,12 +122,15 @@ class File:
     def rename(self, new_name):
         shutil.move(self.filename, new_name)
         self.filename = new_name
+        self.invalidate_stat()
 
     def trash(self):
         trash(self.filename)
+        self.invalidate_stat()
 
     def untrash(self):
         untrash(self.filename)
+        self.invalidate_stat()
 
     def external_open(self):
         external_open(self.filename)
@@ -144,9 +164,29 @@ class File:
     def get_metadata(self):
         return []
 
+def get_pixbuf_size(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+# Level of the pyramid of an image of the given full size (the original
+# scaled by 1/2^level) that is the smallest one still larger than the
+# given size:
+def get_level(full_size, width, height):
+    full_width, full_height = full_size
+
+    level = 0
+    while ((full_width >> (level + 1)) >= width and
+           (full_height >> (level + 1)) >= height):
+        level += 1
+
+    return level
+
 class ImageFile(File):
     description = "image"
-    pixbuf_cache = Cache(10)
+    # Both the decoded images and their pyramid levels share this budget:
+    pixbuf_cache = Cache(max_size=256*1024*1024, sizeof=get_pixbuf_size)
+    # Scaled versions, ready to be drawn:
+    render_cache = Cache(max_size=64*1024*1024, sizeof=get_pixbuf_size)
+    metadata_cache = PersistentCache("metadata")
 
     def __init__(self, filename):
         File.__init__(self, filename)
@@ -154,17 +194,74 @@ class ImageFile(File):
         self.flip_h = False
         self.flip_v = False
 
-    def draw(self, widget, width, height):
-        widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height))
+    # The persistent metadata follows the file:
+    def rename(self, new_name):
+        filename = self.get_filename()
+        File.rename(self, new_name)
+        self.metadata_cache.move(filename, new_name)
+
+    def trash(self):
+        File.trash(self)
+        self.metadata_cache.invalidate(self.get_filename())
+
+    def draw(self, widget, width, height, interp=gtk.gdk.INTERP_BILINEAR):
+        widget.set_from_pixbuf(self.get_pixbuf_at_size(width, height, interp))
+        tracker.stage("paint")
+
+    # Whether a quick draw can be replaced later by a better quality one:
+    def can_be_refined(self):
+        return True
+
+    # Whether the file is an image that the decoder backend can decode:
+    def can_be_decoded(self):
+        return True
 
     @cached(pixbuf_cache)
     def get_pixbuf(self):
         try:
+            if decoder.backend:
+                return decoder.backend.decode(self.get_filename())
             return gtk.gdk.pixbuf_new_from_file(self.get_filename())
         except Exception as e:
             print("Warning:", e)
             return self.get_empty_pixbuf()
 
+    # The key used by the cached decorator for get_pixbuf:
+    def is_decoded(self):
+        return (hash(self), "get_pixbuf") in self.pixbuf_cache
+
+    # Decodes the file directly at a reduced scale with the decoder backend,
+    # unless the image is already decoded or the (unrotated) size isn't
+    # reduced. The result is the level of the pyramid for that size, so
+    # it's cached and reused by the next sizes. With decode=False, only a
+    # level that is already decoded is returned:
+    def decode_at_size(self, width, height, decode=True):
+        if not decoder.backend or not self.can_be_decoded() or self.is_decoded():
+            return None
+
+        level = get_level(self.get_original_dimensions(), width, height)
+
+        # Any bigger level will do:
+        for decoded in range(level, 0, -1):
+            if (hash(self), "get_decoded_level", decoded) in self.pixbuf_cache:
+                return self.get_decoded_level(decoded)
+
+        if not level or not decode:
+            return None
+
+        try:
+            return self.get_decoded_level(level)
+        except Exception as e:
+            print("Warning:", e)
+            return None
+
+    @cached(pixbuf_cache)
+    def get_decoded_level(self, level):
+        full_width, full_height = self.get_original_dimensions()
+        return decoder.backend.decode(self.get_filename(),
+                                      max(full_width >> level, 1),
+                                      max(full_height >> level, 1))
+
     def toggle_flip(self, horizontal):
         if horizontal:
             self.flip_h = not self.flip_h
@@ -178,27 +275,175 @@ class ImageFile(File):
     def get_rotation(self):
         return (self.get_orientation() + self.rotation) % 360
 
-    def get_pixbuf_at_size(self, width, height):
+    # Mipmap pyramid: level n is the original image scaled by 1/2^n. The
+    # levels are generated lazily, each one from the previous level.
+    @cached(pixbuf_cache)
+    def get_pixbuf_level(self, level):
+        upper = self.get_pixbuf_level(level - 1) if level > 1 else self.get_pixbuf()
+        return upper.scale_simple(max(upper.get_width() // 2, 1),
+                                  max(upper.get_height() // 2, 1),
+                                  gtk.gdk.INTERP_BILINEAR)
+
+    # Returns the smallest level that is still larger than the given size:
+    def get_nearest_level(self, width, height):
+        pixbuf = self.get_pixbuf()
+        level = get_level((pixbuf.get_width(), pixbuf.get_height()),
+                          width, height)
+        return self.get_pixbuf_level(level) if level else pixbuf
+
+    # Only the final quality renders are cached (the quick previews would
+    # evict them), but they are also used as previews when available:
+    def get_pixbuf_at_size(self, width, height, interp=gtk.gdk.INTERP_BILINEAR):
+        key = self.get_render_key(width, height, gtk.gdk.INTERP_BILINEAR)
+        try:
+            pixbuf = self.render_cache[key]
+            tracker.flag("render_hit", True)
+            return pixbuf
+        except KeyError:
+            tracker.flag("render_hit", False)
+
+        # The quick previews don't wait for the decoder processes (but
+        # they use what they have already decoded):
+        width, height = self.get_unrotated_size(width, height)
+        level = (self.decode_at_size(width, height,
+                                     decode=(interp != gtk.gdk.INTERP_NEAREST)) or
+                 self.get_nearest_level(width, height))
+        tracker.stage("decode")
+        pixbuf = self.transform(level, width, height, interp)
+        tracker.stage("scale")
+        if interp == gtk.gdk.INTERP_BILINEAR and key not in self.render_cache:
+            self.render_cache[key] = pixbuf
+        return pixbuf
+
+    def is_rendered(self, width, height, interp=gtk.gdk.INTERP_BILINEAR):
+        return self.get_render_key(width, height, interp) in self.render_cache
+
+    def get_render_key(self, width, height, interp):
+        return (self.get_render_id(), width, height, interp,
+                self.get_rotation(), self.flip_h, self.flip_v)
+
+    def get_render_id(self):
+        return self.get_filename()
+
+    # Same as get_pixbuf_at_size, but the embedded EXIF thumbnail is used
+    # instead of decoding the image if it's big enough:
+    def get_thumbnail_at_size(self, width, height, interp=gtk.gdk.INTERP_BILINEAR):
+        if "thumbnail" in self.get_exif():
+            unrotated_width, unrotated_height = self.get_unrotated_size(width, height)
+            try:
+                thumbnail = self.get_embedded_thumbnail()
+                if (thumbnail.get_width() >= unrotated_width and
+                    thumbnail.get_height() >= unrotated_height and
+                    self.has_same_aspect(thumbnail)):
+                    return self.transform(thumbnail,
+                                          unrotated_width, unrotated_height,
+                                          interp)
+            except Exception as e:
+                print("Warning: unusable embedded thumbnail:", e)
+
+        return self.get_pixbuf_at_size(width, height, interp)
+
+    @cached(pixbuf_cache)
+    def get_embedded_thumbnail(self):
+        offset, length = self.get_exif()["thumbnail"]
+
+        with open(self.get_filename(), "rb") as input_:
+            input_.seek(offset)
+            data = input_.read(length)
+
+        loader = gtk.gdk.PixbufLoader()
+        loader.write(data)
+        loader.close()
+        return loader.get_pixbuf()
+
+    # Some cameras add black bands to the thumbnails to fit them in 4:3:
+    def has_same_aspect(self, pixbuf):
+        width, height = self.get_original_dimensions()
+        aspect = float(width) / height
+        return abs(aspect - float(pixbuf.get_width()) / pixbuf.get_height()) < 0.02
+
+    # Scales a pixbuf (not rotated yet) to the given size, then it applies
+    # the rotation and flipping:
+    def transform(self, pixbuf, width, height, interp):
         angle_constants = {0: gtk.gdk.PIXBUF_ROTATE_NONE,
                            90: gtk.gdk.PIXBUF_ROTATE_CLOCKWISE,
                            180: gtk.gdk.PIXBUF_ROTATE_UPSIDEDOWN,
                            270: gtk.gdk.PIXBUF_ROTATE_COUNTERCLOCKWISE}
 
-        pixbuf = self.get_pixbuf()
-        rotated = pixbuf.rotate_simple(angle_constants[self.get_rotation()])
-        scaled = rotated.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
-        flipped = scaled.flip(True) if self.flip_h else scaled
+        scaled = pixbuf.scale_simple(width, height, interp)
+        rotated = scaled.rotate_simple(angle_constants[self.get_rotation()])
+        flipped = rotated.flip(True) if self.flip_h else rotated
         flipped = flipped.flip(False) if self.flip_v else flipped
 
         return flipped
 
-    def get_dimensions(self):
-        width, height = (self.get_pixbuf().get_width(),
-                         self.get_pixbuf().get_height())
-
+    # Renders the region (x, y, width, height) of the image scaled to
+    # (total_width, total_height), with the rotation and flipping applied.
+    # The region is mapped back to the original image, so only the tile
+    # is rotated and flipped (never the full resolution image):
+    def get_tile(self, x, y, width, height, total_width, total_height,
+                       interp=gtk.gdk.INTERP_BILINEAR):
+        # The flipping is applied after the rotation:
+        if self.flip_h:
+            x = total_width - x - width
+        if self.flip_v:
+            y = total_height - y - height
+
+        rotation = self.get_rotation()
+        unrotated_width, unrotated_height = self.get_unrotated_size(total_width,
+                                                                    total_height)
+        if rotation == 90:
+            x, y, width, height = y, unrotated_height - x - width, height, width
+        elif rotation == 180:
+            x, y = unrotated_width - x - width, unrotated_height - y - height
+        elif rotation == 270:
+            x, y, width, height = unrotated_width - y - height, x, height, width
+
+        source = self.get_pixbuf()
+        tile = gtk.gdk.Pixbuf(colorspace=gtk.gdk.COLORSPACE_RGB,
+                              has_alpha=source.get_has_alpha(),
+                              bits_per_sample=8,
+                              width=width,
+                              height=height)
+        source.scale(tile, 0, 0, width, height, -x, -y,
+                     float(unrotated_width) / source.get_width(),
+                     float(unrotated_height) / source.get_height(),
+                     interp)
+        return self.transform(tile, width, height, gtk.gdk.INTERP_NEAREST)
+
+    def get_unrotated_size(self, width, height):
         if self.get_rotation() in (90, 270):
-            width, height = height, width
+            return height, width
+        return width, height
+
+    # The dimensions are read from the file header when possible, so the
+    # image doesn't need to be decoded:
+    @cached()
+    def get_original_dimensions(self):
+        info = None
+        if self.get_filename():
+            try:
+                info = gtk.gdk.pixbuf_get_file_info(self.get_filename())
+            except Exception:
+                pass
+
+        if info:
+            _, width, height = info
+        else:
+            pixbuf = self.get_pixbuf()
+            width, height = pixbuf.get_width(), pixbuf.get_height()
+
+        return width, height
+
+    # Whether the dimensions are already known (getting them may decode
+    # the file, e.g. the first frame of a video):
+    def has_dimensions(self):
+        cache = getattr(self, "__cache__", None)
+        return (cache is not None and
+                (hash(self), "get_original_dimensions") in cache)
 
+    def get_dimensions(self):
+        width, height = self.get_unrotated_size(*self.get_original_dimensions())
         return ImageDimensions(width, height)
 
     def get_dimensions_to_fit(self, width, height):
@@ -214,6 +459,42 @@ class ImageFile(File):
 
         return width, height
 
+    @cached()
+    def get_exif(self):
+        # Other types (videos, PDFs, archives...) have nothing to store:
+        if not has_exif(self.get_filename()):
+            return {}
+
+        try:
+            return self.get_stored_exif()
+        except (IOError, OSError):
+            return {}
+
+    # The key includes the file signature, so modified files are re-read:
+    @cached(metadata_cache,
+            key_func=lambda self: (self.get_filename(), "exif",
+                                   self.get_stat().st_mtime,
+                                   self.get_stat().st_size))
+    def get_stored_exif(self):
+        return read_exif(self.get_filename())
+
+    @cached(metadata_cache,
+            key_func=lambda self: (self.get_filename(), phash.ALGORITHM,
+                                   self.get_stat().st_mtime,
+                                   self.get_stat().st_size))
+    def get_perceptual_hash(self):
+        return phash.get_hash(self.get_hash_pixbuf())
+
+    # The image is decoded directly at the small size (the JPEG loader
+    # only decodes what it needs), bypassing the caches:
+    def get_hash_pixbuf(self):
+        if self.can_be_decoded():
+            return gtk.gdk.pixbuf_new_from_file_at_scale(self.get_filename(),
+                                                         phash.SIZE, phash.SIZE,
+                                                         False)
+        return self.get_pixbuf_at_size(phash.SIZE, phash.SIZE)
+
+    # Full decoding, only needed to show the metadata:
     @cached()
     def get_tags(self):
         tags = {}
@@ -236,7 +517,7 @@ class ImageFile(File):
         # Orientation constants taken from:
         # http://sylvana.net/jpegcrop/exif_orientation.html
         angle_constants = {3: 180, 6: 90, 8: 270}
-        orientation = self.get_tags().get("Orientation", 0)
+        orientation = self.get_exif().get("ifd0", {}).get(ORIENTATION, 0)
         return angle_constants.get(orientation, 0)
 
     def get_empty_pixbuf(self):
@@ -255,9 +536,12 @@ class EmptyImage(ImageFile):
     def get_pixbuf(self):
         return self.get_empty_pixbuf()
 
-    def get_pixbuf_at_size(self, width, height):
+    def get_pixbuf_at_size(self, width, height, interp=None):
         return self.get_empty_pixbuf()
 
+    def can_be_refined(self):
+        return False
+
     def get_mtime(self):
         return "None"
 
@@ -280,9 +564,15 @@ class GTKIconImage(ImageFile):
     def __repr__(self):
         return "GTKIconImage(%s, %d)" % (self.stock_id, self.size)
 
-    def get_pixbuf_at_size(self, width, height):
+    def get_render_id(self):
+        return repr(self)
+
+    def get_pixbuf_at_size(self, width, height, interp=None):
         theme = gtk.icon_theme_get_default()
         return theme.load_icon(self.stock_id, width, 0)
 
+    def can_be_refined(self):
+        return False
+
     def get_dimensions(self):
         return ImageDimensions(self.size, self.size)
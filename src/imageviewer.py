@@ -1,15 +1,49 @@
 import gtk
 import math
+import gobject
+
+from cache import Cache
+from filescanner import FileScanner
+from latency import tracker
 
 class ImageViewer:
-    def __init__(self):
+    TILE_SIZE = 256
+    TILE_CACHE_LIMIT = 256 # about 48 Mb of RGB tiles
+
+    def __init__(self, refiner=None, tiled=False):
         self.widget = gtk.Image()
         self.zoom_factor = 100
         self.image_file = None
         self.size = (1, 1)
 
+        # Progressive mode: when a worker is given, a quick preview is drawn
+        # first and the high quality version is rendered in the worker.
+        self.refiner = refiner
+        self.generation = 0
+        self.held_trace = None # held until the refinement arrives
+
+        # Tiled mode: when zooming in, only the visible tiles are rendered
+        # in a drawing area instead of scaling the whole image.
+        self.container = None
+        self.tiled = False
+        if tiled:
+            self.canvas = gtk.DrawingArea()
+            self.canvas.connect("expose-event", self.on_canvas_expose)
+            self.canvas_align = gtk.Alignment(0.5, 0.5, 0, 0)
+            self.canvas_align.add(self.canvas)
+            self.canvas_align.set_no_show_all(True)
+            self.canvas.show()
+
+            self.container = gtk.VBox(False, 0)
+            self.container.pack_start(self.widget, True, True, 0)
+            self.container.pack_start(self.canvas_align, True, True, 0)
+
+            self.tile_cache = Cache(self.TILE_CACHE_LIMIT)
+            self.pending_tiles = []
+            self.prefetching = None # generation of the idle handler
+
     def get_widget(self):
-        return self.widget
+        return self.container or self.widget
 
     def get_zoom_factor(self):
         return self.zoom_factor
@@ -63,24 +97,183 @@ class ImageViewer:
         self.redraw()
 
     def get_scaled_size(self):
-        dimensions = self.image_file.get_dimensions()
+        return self.get_size_at_zoom(self.image_file, self.zoom_factor)
 
-        width = int((dimensions.get_width() * self.zoom_factor) / 100)
-        height = int((dimensions.get_height() * self.zoom_factor) / 100)
+    def get_size_at_zoom(self, image_file, zoom_factor):
+        dimensions = image_file.get_dimensions()
+
+        width = int((dimensions.get_width() * zoom_factor) / 100)
+        height = int((dimensions.get_height() * zoom_factor) / 100)
 
         return width, height
 
+    # Size at which the given file would be drawn by zoom_at_size:
+    def get_fit_size(self, image_file, width, height):
+        return self.get_size_at_zoom(image_file,
+                                     self.get_zoom_to_fit(image_file, width, height))
+
     def redraw(self):
         width, height = self.get_scaled_size()
-        self.image_file.draw(self.widget, width, height)
+
+        # Any pending refinement is obsolete from now on:
+        self.generation += 1
+        tracker.stage("reload")
+
+        if (self.container and self.zoom_factor > 100 and
+            self.image_file.can_be_refined()):
+            self.draw_tiled(width, height)
+            self.release_trace()
+            return
+
+        self.set_tiled(False)
+
+        if (self.refiner and self.image_file.can_be_refined() and
+            not self.image_file.is_rendered(width, height)):
+            self.image_file.draw(self.widget, width, height, gtk.gdk.INTERP_NEAREST)
+            self.held_trace = tracker.hold()
+            self.refiner.clear()
+            self.refiner.push((self.refine,
+                               (self.image_file, width, height, self.generation)))
+        else:
+            self.image_file.draw(self.widget, width, height)
+            self.release_trace()
+
+    # The trace held for a refinement is finished once it arrives, or
+    # once it's superseded by a draw that doesn't need one:
+    def release_trace(self):
+        if self.held_trace is not None:
+            tracker.release(self.held_trace)
+            self.held_trace = None
+
+    # This is done in a separate thread:
+    def refine(self, image_file, width, height, generation):
+        if generation != self.generation:
+            return (None, None)
+        pixbuf = image_file.get_pixbuf_at_size(width, height)
+        return (self.on_refined, (pixbuf, generation))
+
+    # This is requested to be done by the main thread:
+    def on_refined(self, pixbuf, generation):
+        if generation == self.generation:
+            self.widget.set_from_pixbuf(pixbuf)
+            tracker.stage("refine")
+            self.release_trace()
+
+    def set_tiled(self, tiled):
+        if not self.container or self.tiled == tiled:
+            return
+
+        self.tiled = tiled
+        if tiled:
+            self.widget.hide()
+            self.widget.clear() # release the (possibly big) previous pixbuf
+            self.canvas_align.show()
+        else:
+            self.canvas_align.hide()
+            self.widget.show()
+
+    def draw_tiled(self, width, height):
+        self.set_tiled(True)
+        self.tiled_size = (width, height)
+        self.pending_tiles = []
+        self.canvas.set_size_request(width, height)
+        self.canvas.queue_draw()
+
+    def get_tile_key(self, column, row):
+        width, height = self.tiled_size
+        image_file = self.image_file
+        return (image_file.get_filename(), width, height,
+                image_file.get_rotation(), image_file.flip_h, image_file.flip_v,
+                column, row)
+
+    def get_tile(self, column, row):
+        key = self.get_tile_key(column, row)
+        try:
+            return self.tile_cache[key]
+        except KeyError:
+            pass
+
+        width, height = self.tiled_size
+        x, y = column * self.TILE_SIZE, row * self.TILE_SIZE
+        tile = self.image_file.get_tile(x, y,
+                                        min(self.TILE_SIZE, width - x),
+                                        min(self.TILE_SIZE, height - y),
+                                        width, height)
+        self.tile_cache[key] = tile
+        return tile
+
+    def get_tile_range(self, x, y, width, height, margin=0):
+        total_width, total_height = self.tiled_size
+        last_column = (total_width - 1) // self.TILE_SIZE
+        last_row = (total_height - 1) // self.TILE_SIZE
+
+        return (max(x // self.TILE_SIZE - margin, 0),
+                max(y // self.TILE_SIZE - margin, 0),
+                min((x + width - 1) // self.TILE_SIZE + margin, last_column),
+                min((y + height - 1) // self.TILE_SIZE + margin, last_row))
+
+    # The exposed area is clipped to the visible region by the viewport:
+    def on_canvas_expose(self, widget, event):
+        if not self.tiled:
+            return False
+
+        area = event.area
+        first_column, first_row, last_column, last_row = \
+            self.get_tile_range(area.x, area.y, area.width, area.height)
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                tile = self.get_tile(column, row)
+                widget.window.draw_pixbuf(None, tile, 0, 0,
+                                          column * self.TILE_SIZE,
+                                          row * self.TILE_SIZE)
+
+        # Render the surrounding tiles when idle, so scrolling is smooth:
+        self.schedule_tiles(*self.get_tile_range(area.x, area.y,
+                                                 area.width, area.height,
+                                                 margin=1))
+        return True
+
+    # A handler of an older generation may still be queued, but it will
+    # stop by itself (and leave the new list alone):
+    def schedule_tiles(self, first_column, first_row, last_column, last_row):
+        self.pending_tiles = [(column, row)
+                              for row in range(first_row, last_row + 1)
+                              for column in range(first_column, last_column + 1)]
+
+        if self.pending_tiles and self.prefetching != self.generation:
+            self.prefetching = self.generation
+            gobject.idle_add(self.prefetch_tile, self.generation,
+                             priority=gobject.PRIORITY_LOW)
+
+    def prefetch_tile(self, generation):
+        if generation != self.generation:
+            return False
+
+        if self.tiled and self.pending_tiles:
+            column, row = self.pending_tiles.pop(0)
+            self.get_tile(column, row)
+
+        if self.tiled and self.pending_tiles:
+            return True
+
+        self.prefetching = None
+        return False
 
     def force_zoom(self, width, height):
-        im_dim = self.image_file.get_dimensions()
+        self.set_zoom_factor(self.get_zoom_to_fit(self.image_file, width, height))
+
+    def get_zoom_to_fit(self, image_file, width, height):
+        im_dim = image_file.get_dimensions()
         zw = (float(width) / im_dim.get_width()) * 99
         zh = (float(height) / im_dim.get_height()) * 99
-        self.set_zoom_factor(min(zw, zh))
+        return min(zw, zh)
 
 class ThumbnailViewer(ImageViewer):
+    # Rendered thumbnails (directory thumbnails are dropped when the
+    # contents of the directory change):
+    thumbnail_cache = Cache(200, top_cache=FileScanner.cache)
+
     def __init__(self, th_size):
         ImageViewer.__init__(self)
         self.th_size = th_size
@@ -96,6 +289,41 @@ class ThumbnailViewer(ImageViewer):
         self.load_at_size(image_file, self.th_size, self.th_size)
         self.redraw()
 
+    # Loads the file only if its thumbnail is already rendered, otherwise
+    # the placeholder is loaded (the dimensions must be known too, the
+    # thumbnail key depends on them):
+    def load_if_cached(self, image_file, placeholder):
+        if (image_file.has_dimensions() and
+            self.get_thumbnail_key(image_file) in self.thumbnail_cache):
+            self.load(image_file)
+        else:
+            self.load(placeholder)
+
+    def get_thumbnail_key(self, image_file):
+        width, height = self.get_thumbnail_size(image_file)
+        return image_file.get_render_key(width, height, "thumbnail")
+
+    def get_thumbnail_size(self, image_file):
+        zoom_factor = self.get_zoom_to_fit(image_file, self.th_size, self.th_size)
+        dimensions = image_file.get_dimensions()
+
+        width = int(math.ceil((dimensions.get_width() * zoom_factor) / 100))
+        height = int(math.ceil((dimensions.get_height() * zoom_factor) / 100))
+
+        return width, height
+
+    def get_thumbnail(self, image_file):
+        key = self.get_thumbnail_key(image_file)
+        try:
+            return self.thumbnail_cache[key]
+        except KeyError:
+            pass
+
+        pixbuf = image_file.get_thumbnail_at_size(*self.get_thumbnail_size(image_file))
+        if key not in self.thumbnail_cache:
+            self.thumbnail_cache[key] = pixbuf
+        return pixbuf
+
     def redraw(self):
         if self.hidden:
             return
@@ -105,13 +333,7 @@ class ThumbnailViewer(ImageViewer):
             return
 
         self.force_zoom(self.th_size, self.th_size)
-
-        dimensions = self.image_file.get_dimensions()
-
-        width = int(math.ceil((dimensions.get_width() * self.zoom_factor) / 100))
-        height = int(math.ceil((dimensions.get_height() * self.zoom_factor) / 100))
-
-        self.widget.set_from_pixbuf(self.image_file.get_pixbuf_at_size(width, height))
+        self.widget.set_from_pixbuf(self.get_thumbnail(self.image_file))
 
     def fill(self):
         pixbuf = gtk.gdk.Pixbuf(colorspace=gtk.gdk.COLORSPACE_RGB,
@@ -0,0 +1,185 @@
+# Persistent undo journal: every action pushed to the undo stack is
+# appended to a file (one JSON object per line) with the changes it made
+# to the files, as well as every undo, so the actions not undone can be
+# undone after a restart (or a crash). The lines are written right away,
+# but they are synced to disk by a separate thread at most once every
+# interval, so a key press only costs a write. The journal is rewritten
+# by the same thread with only the live actions (compacted) when most of
+# its lines are dead. The compaction also drops the actions older than
+# MAX_AGE and all but the MAX_ENTRIES most recent ones.
+#
+# Line formats:
+#  {"op": "push", "id": ..., "time": ..., "severity": ..., "description": ..., "changes": [...]}
+#  {"op": "pop", "id": ...}
+#  {"op": "clear"}
+# where every change is one of ["move", source, target], ["copy", source,
+# target] or ["trash", filename].
+import os
+import json
+import time
+import fcntl
+import itertools
+
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+
+class Journal(Thread):
+    COMPACT_SLACK = 200 # dead lines allowed before compacting
+    MAX_ENTRIES = 1000
+    MAX_AGE = 30 * 24 * 3600 # seconds
+
+    def __init__(self, filename, interval=1.0):
+        Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.stopped = Event()
+
+        self.lock = Lock()
+        self.output = None
+        self.dirty = False
+        self.compact_requested = False
+        self.entries = OrderedDict() # id -> push line, the live ones
+        self.lines = 0
+        self.ids = itertools.count()
+
+    # Returns False if the journal is in use by another instance:
+    def open(self):
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # Held for the whole session:
+        self.lock_file = open(self.filename + ".lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.lock_file.close()
+            return False
+
+        self.load()
+        self.compact()
+        self.start()
+        return True
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+
+        with open(self.filename) as input_:
+            for line in input_:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut by a crash:
+                    continue
+
+                if entry["op"] == "push":
+                    # Written before the entries had a time:
+                    entry.setdefault("time", time.time())
+                    self.entries[entry["id"]] = entry
+                elif entry["op"] == "pop":
+                    self.entries.pop(entry["id"], None)
+                elif entry["op"] == "clear":
+                    self.entries.clear()
+
+        ids = [entry["id"] for entry in self.entries.values()]
+        self.ids = itertools.count(max(ids) + 1 if ids else 0)
+
+    # Returns the live entries, the oldest first:
+    def get_entries(self):
+        with self.lock:
+            return list(self.entries.values())
+
+    # Returns the id of the new entry:
+    def push(self, severity, description, changes):
+        entry = {"op": "push",
+                 "id": next(self.ids),
+                 "time": time.time(),
+                 "severity": severity,
+                 "description": description,
+                 "changes": changes}
+        with self.lock:
+            self.entries[entry["id"]] = entry
+            self.write(entry)
+        return entry["id"]
+
+    def pop(self, id_):
+        with self.lock:
+            self.entries.pop(id_, None)
+            self.write({"op": "pop", "id": id_})
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.write({"op": "clear"})
+
+    # Called with the lock held:
+    def write(self, entry):
+        try:
+            self.output.write(json.dumps(entry) + "\n")
+            self.output.flush()
+        except (IOError, OSError) as e:
+            print("Warning:", e)
+            return
+        self.dirty = True
+        self.lines += 1
+
+        if self.lines > len(self.entries) + self.COMPACT_SLACK:
+            self.compact_requested = True
+
+    # The entries too old (or beyond the limit) are dropped:
+    def expire(self):
+        oldest = time.time() - self.MAX_AGE
+        entries = [entry for entry in self.entries.values()
+                   if entry["time"] >= oldest]
+        self.entries = OrderedDict((entry["id"], entry)
+                                   for entry in entries[-self.MAX_ENTRIES:])
+
+    # The live entries are written to a new file, which replaces the
+    # journal once it's on disk:
+    def compact(self):
+        with self.lock:
+            self.expire()
+
+            partial = self.filename + ".new"
+            with open(partial, "w") as output:
+                for entry in self.entries.values():
+                    output.write(json.dumps(entry) + "\n")
+                output.flush()
+                os.fsync(output.fileno())
+            os.rename(partial, self.filename)
+
+            if self.output:
+                self.output.close()
+            self.output = open(self.filename, "a")
+            self.dirty = False
+            self.compact_requested = False
+            self.lines = len(self.entries)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.compact_requested:
+                try:
+                    self.compact()
+                except (IOError, OSError) as e:
+                    print("Warning:", e)
+                    self.compact_requested = False
+            else:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.output.fileno())
+                self.dirty = False
+
+    def close(self):
+        self.stopped.set()
+        self.join()
+        self.sync()
+
+        with self.lock:
+            self.output.close()
+            self.output = None
+        self.lock_file.close()
@@ -0,0 +1,142 @@
+# Key-to-pixel latency instrumentation. A trace is started for every key
+# press, and the code in the navigation path marks the end of its stages
+# (the time of a stage is the time since the previous mark). The trace is
+# finished once the main loop is idle again (or when the held refinement
+# arrives), and its timings are added to the rolling percentiles and
+# written to the JSON log (one object per line).
+# Only the main thread is traced, the work done by the loaders is not.
+import json
+import time
+import threading
+
+from collections import deque
+
+class LatencyTracker:
+    WINDOW = 200 # traces used for the percentiles
+
+    def __init__(self):
+        self.enabled = False
+        self.log = None
+        self.on_update = None
+        self.thread = threading.current_thread()
+        self.samples = {}
+        self.trace = None
+
+    def enable(self, log_filename=None):
+        self.enabled = True
+        if log_filename:
+            self.log = open(log_filename, "a")
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def is_tracing(self):
+        return (self.trace is not None and
+                threading.current_thread() is self.thread)
+
+    def start(self, event):
+        if not self.enabled:
+            return
+
+        # A trace still open (e.g. held for a slow refinement) is finished
+        # first, so the slowest navigations aren't dropped. Its timings are
+        # a lower bound, it's flagged as incomplete in the log:
+        if self.trace is not None:
+            self.trace["held"] = False
+            self.trace["flags"]["incomplete"] = True
+            self.finish()
+
+        now = time.time()
+        self.trace = {"event": event,
+                      "start": now,
+                      "mark": now,
+                      "stages": {},
+                      "order": [],
+                      "flags": {},
+                      "held": False}
+
+    def stage(self, name):
+        if not self.is_tracing():
+            return
+
+        now = time.time()
+        stages = self.trace["stages"]
+        if name not in stages:
+            stages[name] = 0.0
+            self.trace["order"].append(name)
+        stages[name] += now - self.trace["mark"]
+        self.trace["mark"] = now
+
+    # Only the first value of a flag is kept (the main viewer is drawn
+    # before the thumbnails):
+    def flag(self, name, value):
+        if self.is_tracing():
+            self.trace["flags"].setdefault(name, value)
+
+    # The trace won't be finished until release is called. Returns the
+    # held trace (None if there's none):
+    def hold(self):
+        if self.is_tracing():
+            self.trace["held"] = True
+            return self.trace
+        return None
+
+    # Only the given trace is released (if it's still open):
+    def release(self, trace):
+        if self.is_tracing() and self.trace is trace:
+            self.trace["held"] = False
+            self.finish()
+
+    def finish(self):
+        if not self.is_tracing() or self.trace["held"]:
+            return
+
+        self.stage("present")
+        trace, self.trace = self.trace, None
+
+        # Keys that don't reach the navigation path are ignored:
+        if len(trace["stages"]) < 2:
+            return
+
+        total = trace["mark"] - trace["start"]
+        self.add_sample("total", total)
+        for name in trace["order"]:
+            self.add_sample(name, trace["stages"][name])
+
+        if self.log:
+            entry = {"event": trace["event"],
+                     "time": trace["start"],
+                     "total_ms": round(total * 1000, 3),
+                     "stages": [(name, round(trace["stages"][name] * 1000, 3))
+                                for name in trace["order"]],
+                     "flags": trace["flags"]}
+            self.log.write(json.dumps(entry) + "\n")
+            self.log.flush()
+
+        if self.on_update:
+            self.on_update()
+
+    def add_sample(self, name, value):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.WINDOW)
+        self.samples[name].append(value)
+
+    # Returns the (p50, p95, p99) of a stage, in milliseconds:
+    def get_percentiles(self, name):
+        samples = sorted(self.samples.get(name, []))
+        if not samples:
+            return None
+
+        def percentile(p):
+            index = min(int(p * len(samples) / 100.0), len(samples) - 1)
+            return samples[index] * 1000
+
+        return percentile(50), percentile(95), percentile(99)
+
+    def get_stages(self):
+        stages = [name for name in self.samples if name != "total"]
+        return ["total"] + sorted(stages) if self.samples else []
+
+tracker = LatencyTracker()
@@ -6,6 +6,10 @@ from collections import defaultdict
 from filefactory import FileFactory
 from filescanner import FileScanner
 from viewerapp import ViewerApp
+from latency import tracker
+
+import decoder
+import mover
 
 def check_directories(args):
     for arg in args:
@@ -33,6 +37,20 @@ def main():
     parser.add_option("-c", "--check", action="store_true", default=False)
     parser.add_option("-s", "--stats", action="store_true", default=False)
     parser.add_option("-b", "--base-dir")
+    parser.add_option("-p", "--prefetch", type="int", default=4,
+                      help="number of files decoded in advance")
+    parser.add_option("--latency-log", metavar="FILE",
+                      help="write the navigation latency traces (JSON lines)")
+    parser.add_option("--latency-overlay", action="store_true", default=False,
+                      help="show the navigation latency percentiles")
+    parser.add_option("-d", "--decoders", type="int", default=0,
+                      help="number of decoder processes (0: decode in-process)")
+    parser.add_option("--soft-limit", type="int", default=0, metavar="MB",
+                      help="RSS above which the caches are shrunk (0: no limit)")
+    parser.add_option("--hard-limit", type="int", default=2048, metavar="MB",
+                      help="RSS above which the caches are emptied")
+    parser.add_option("--verify-moves", action="store_true", default=False,
+                      help="compare the checksums of the files moved to other devices")
 
     options, args = parser.parse_args()
 
@@ -50,8 +68,26 @@ def main():
         print_stats(files)
         return
 
+    # The decoder processes must be forked before starting any thread:
+    if options.decoders > 0:
+        decoder.enable(options.decoders)
+
+    mover.verify = options.verify_moves
+
+    if options.latency_log or options.latency_overlay:
+        tracker.enable(options.latency_log)
+
+    memory_limits = None
+    if options.soft_limit > 0:
+        memory_limits = (options.soft_limit * 1024 * 1024,
+                         max(options.hard_limit, options.soft_limit) * 1024 * 1024)
+
     try:
-        app = ViewerApp(files, start_file, options.base_dir)
+        app = ViewerApp(files, start_file, options.base_dir,
+                        prefetch_ahead=options.prefetch,
+                        prefetch_behind=min(options.prefetch, 1),
+                        latency_overlay=options.latency_overlay,
+                        memory_limits=memory_limits)
         app.run()
     except Exception as e:
         import traceback
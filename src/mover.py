@@ -0,0 +1,245 @@
+# Moves of files between devices. A move inside the same device is just a
+# rename, but a move to another device (e.g. a big video to an external
+# disk) is a copy: the file is streamed to a hidden partial file next to
+# the target, synced to disk, optionally verified against the source, and
+# only then it's renamed to the target and the source is deleted. If
+# anything fails (or the move is cancelled) the source is left untouched.
+# The copies are done in order by a separate I/O thread, so the UI doesn't
+# wait for them. As with the scheduler, the results are delivered to the
+# main thread with gobject.idle_add.
+import os
+import shutil
+import hashlib
+
+from collections import deque
+from threading import Thread, Lock, Condition
+
+import gobject
+
+CHUNK_SIZE = 1024 * 1024
+
+# Whether the copies are read again and compared with the source before
+# deleting it (--verify-moves):
+verify = False
+
+def is_same_device(filename, target_dir):
+    return os.stat(filename).st_dev == os.stat(target_dir).st_dev
+
+def get_checksum(filename):
+    sha1 = hashlib.sha1()
+
+    with open(filename, "rb") as input_:
+        while True:
+            chunk = input_.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+def sync_directory(dirname):
+    try:
+        fd = os.open(dirname or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # not supported by every filesystem
+
+class MoveCancelled(Exception):
+    pass
+
+class Move:
+    PENDING = 0
+    RUNNING = 1
+    COMMITTING = 2 # past the point where it can be cancelled
+    DONE = 3
+    FAILED = 4
+    CANCELLED = 5
+
+    def __init__(self, source, target, on_finish=lambda move: None):
+        self.source = source
+        self.target = target
+        self.on_finish = on_finish
+
+        self.lock = Lock()
+        self.state = Move.PENDING
+        self.cancelled = False
+        self.progress = 0.0
+        self.error = None
+
+    # Returns True if it was cancelled in time (the source won't be
+    # touched):
+    def cancel(self):
+        with self.lock:
+            if self.state in (Move.PENDING, Move.RUNNING):
+                self.cancelled = True
+                return True
+            return False
+
+    def is_active(self):
+        return not self.cancelled and self.state < Move.DONE
+
+    # This is done in the I/O thread:
+    def run(self, on_progress):
+        target_dir, target_name = os.path.split(self.target)
+        partial = os.path.join(target_dir, ".%s.part" % target_name)
+
+        try:
+            self.copy(partial, on_progress)
+            shutil.copystat(self.source, partial)
+
+            if verify and get_checksum(self.source) != get_checksum(partial):
+                raise IOError("'%s' differs from its copy" % self.source)
+
+            with self.lock:
+                if self.cancelled:
+                    raise MoveCancelled()
+                self.state = Move.COMMITTING
+
+            # Never overwrite, the target may have appeared meanwhile:
+            if os.path.exists(self.target):
+                raise IOError("'%s' already exists" % self.target)
+            os.rename(partial, self.target)
+        except:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            raise
+
+        # The target must be on disk before the source is deleted:
+        sync_directory(target_dir)
+        os.unlink(self.source)
+
+    def copy(self, partial, on_progress):
+        with open(self.source, "rb") as input_:
+            with open(partial, "wb") as output:
+                total = float(os.fstat(input_.fileno()).st_size) or 1.0
+                copied = 0
+
+                while True:
+                    if self.cancelled:
+                        raise MoveCancelled()
+
+                    chunk = input_.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+
+                    copied += len(chunk)
+                    self.progress = copied / total
+                    on_progress()
+
+                output.flush()
+                os.fsync(output.fileno())
+
+class MoveQueue(Thread):
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.stopped = False
+        self.pending = deque()
+        self.current = None
+        self.reported = None
+
+        # Invoked by the main thread when the progress changes:
+        self.on_progress = lambda: None
+
+    def push(self, move):
+        with self.cond:
+            self.pending.append(move)
+            self.cond.notify()
+        self.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                self.current = move = self.pending.popleft()
+
+            self.execute(move)
+
+            with self.cond:
+                self.current = None
+            self.notify()
+
+    def execute(self, move):
+        with move.lock:
+            if move.cancelled:
+                move.state = Move.CANCELLED
+            else:
+                move.state = Move.RUNNING
+
+        if move.state == Move.RUNNING:
+            try:
+                move.run(self.notify_progress)
+                move.state = Move.DONE
+            except MoveCancelled:
+                move.state = Move.CANCELLED
+            except Exception as e:
+                print("Warning:", e)
+                move.error = e
+                move.state = Move.FAILED
+
+        gobject.idle_add(move.on_finish, move)
+
+    # The UI is only notified when the percentage changes:
+    def notify_progress(self):
+        status = self.get_status()
+        if status != self.reported:
+            self.reported = status
+            self.notify()
+
+    def notify(self):
+        gobject.idle_add(lambda: self.on_progress())
+
+    # Returns the move in progress (or None), its percentage and the
+    # number of moves waiting:
+    def get_status(self):
+        with self.lock:
+            current = self.current
+            waiting = len([move for move in self.pending if move.is_active()])
+
+        if current and current.is_active():
+            return current, int(current.progress * 100), waiting
+        return None, 0, waiting
+
+    # Whether a file is going to be moved to the given filename:
+    def is_pending_target(self, filename):
+        with self.lock:
+            moves = list(self.pending) + [self.current]
+        return any(move and move.is_active() and move.target == filename
+                   for move in moves)
+
+    # The moves not finished are cancelled (their sources are untouched):
+    def stop(self):
+        with self.cond:
+            moves = list(self.pending) + [self.current]
+            self.stopped = True
+            self.cond.notify_all()
+
+        for move in moves:
+            if move and move.is_active() and move.cancel():
+                print("Warning: move of '%s' cancelled" % move.source)
+
+        self.join()
+
+# The queue is shared by the whole application:
+queue = None
+
+def get_mover():
+    global queue
+    if not queue:
+        queue = MoveQueue()
+        queue.start()
+    return queue
+
+def stop():
+    if queue:
+        queue.stop()
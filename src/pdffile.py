@@ -73,6 +73,9 @@ class PDFFile(ImageFile):
     def can_be_extracted(self):
         return True
 
+    def can_be_decoded(self):
+        return False
+
 class PDFGenerator:
     def generate(self, files, output):
         try:
@@ -0,0 +1,247 @@
+# Perceptual hashes: the copies of an image (resized, re-encoded, slightly
+# retouched) get hashes that only differ in a few bits, so the similarity
+# of two images is the Hamming distance of their hashes. Both are 64 bit
+# integers computed over an image downscaled by gdk-pixbuf:
+#  - pHash: the signs (relative to the median) of the 8x8 lowest
+#    frequencies of the DCT of the 32x32 grayscale image. Needs NumPy.
+#  - dHash: whether each pixel of the 9x8 grayscale image is brighter than
+#    its right neighbour. Used when NumPy isn't available.
+# Reference: http://www.hackerfactor.com/blog/?/archives/432-Looks-Like-It.html
+import itertools
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+from threading import RLock
+
+import gtk
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ALGORITHM = "phash" if numpy else "dhash"
+SIZE = 32 # size of the image to load for hashing
+THRESHOLD = 10 # max distance between similar images
+
+if numpy:
+    # Coefficients of the (unnormalized) DCT-II, so dct(m) = C . m . C^T
+    _k = numpy.arange(SIZE).reshape(SIZE, 1)
+    _i = numpy.arange(SIZE).reshape(1, SIZE)
+    DCT_MATRIX = numpy.cos(numpy.pi * (2 * _i + 1) * _k / (2.0 * SIZE))
+
+def get_gray_matrix(pixbuf):
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    channels, rowstride = pixbuf.get_n_channels(), pixbuf.get_rowstride()
+
+    # The last row may not be padded to the rowstride:
+    pixels = numpy.frombuffer(pixbuf.get_pixels(), dtype=numpy.uint8)
+    data = numpy.zeros(rowstride * height, dtype=numpy.uint8)
+    data[:len(pixels)] = pixels
+
+    rgb = data.reshape(height, rowstride)[:, :width * channels]
+    rgb = rgb.reshape(height, width, channels)[:, :, :3]
+    return rgb.dot([0.299, 0.587, 0.114])
+
+def get_gray_rows(pixbuf):
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    channels, rowstride = pixbuf.get_n_channels(), pixbuf.get_rowstride()
+    pixels = bytearray(pixbuf.get_pixels())
+
+    rows = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            offset = y * rowstride + x * channels
+            r, g, b = pixels[offset:offset+3]
+            row.append(0.299 * r + 0.587 * g + 0.114 * b)
+        rows.append(row)
+    return rows
+
+def to_integer(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+def get_phash(pixbuf):
+    pixbuf = pixbuf.scale_simple(SIZE, SIZE, gtk.gdk.INTERP_BILINEAR)
+    gray = get_gray_matrix(pixbuf)
+    low = DCT_MATRIX.dot(gray).dot(DCT_MATRIX.T)[:8, :8]
+    return to_integer((low > numpy.median(low)).flatten())
+
+def get_dhash(pixbuf):
+    pixbuf = pixbuf.scale_simple(9, 8, gtk.gdk.INTERP_BILINEAR)
+    return to_integer(left > right
+                      for row in get_gray_rows(pixbuf)
+                      for left, right in zip(row[:-1], row[1:]))
+
+def get_hash(pixbuf):
+    if numpy:
+        return get_phash(pixbuf)
+    return get_dhash(pixbuf)
+
+def get_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+# Multi-index hash table: the hashes are split in CHUNKS chunks, and every
+# chunk is indexed in its own table. If two hashes are within a distance
+# r, at least one of their chunks is within r // CHUNKS (pigeonhole), so a
+# search only looks up the variants of the chunks of the query up to that
+# distance, and then checks the full distance of the few candidates.
+# Reference: Norouzi et al., "Fast Search in Hamming Space with Multi-Index
+# Hashing" (CVPR 2012)
+class MultiIndexHashTable:
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self):
+        self.tables = [{} for index in range(self.CHUNKS)]
+        self.size = 0
+
+    def get_chunks(self, hash_):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(hash_ >> (index * self.CHUNK_BITS)) & mask
+                for index in range(self.CHUNKS)]
+
+    def add(self, hash_, item):
+        self.size += 1
+        for table, chunk in zip(self.tables, self.get_chunks(hash_)):
+            table.setdefault(chunk, []).append((hash_, item))
+
+    def remove(self, hash_, item):
+        self.size -= 1
+        for table, chunk in zip(self.tables, self.get_chunks(hash_)):
+            bucket = table[chunk]
+            bucket.remove((hash_, item))
+            if not bucket:
+                del table[chunk]
+
+    # Returns the (distance, item) within the radius, nearest first:
+    def search(self, hash_, radius):
+        found = {} # item -> distance
+
+        for table, chunk in zip(self.tables, self.get_chunks(hash_)):
+            for variant in get_variants(chunk, self.CHUNK_BITS, radius // self.CHUNKS):
+                for candidate, item in table.get(variant, ()):
+                    if item in found:
+                        continue
+
+                    distance = get_distance(hash_, candidate)
+                    if distance <= radius:
+                        found[item] = distance
+
+        return sorted(((distance, item) for item, distance in found.items()),
+                      key=lambda result: result[0])
+
+# All the values within the given distance of a value:
+def get_variants(value, bits, distance):
+    variants = [value]
+    for flips in range(1, distance + 1):
+        for positions in itertools.combinations(range(bits), flips):
+            variant = value
+            for position in positions:
+                variant ^= 1 << position
+            variants.append(variant)
+    return variants
+
+# Index of the hashes of a collection, built incrementally (the hashes
+# themselves are also kept in the metadata cache, see
+# ImageFile.get_perceptual_hash). The files are indexed by name, and the
+# hashes are kept by inode (device, inode, mtime and size), so a file
+# that is renamed or moved within its device is indexed again under its
+# new name without hashing it:
+class SimilarityIndex:
+    def __init__(self, threads=None):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.lock = RLock()
+        self.table = MultiIndexHashTable() # of filenames
+        self.indexed = {} # filename -> signature
+        self.hashes = {} # signature -> hash (None if it can't be hashed)
+
+    # Indexes the files whose contents are already hashed, and returns
+    # the ones that have to be hashed:
+    def get_missing(self, files):
+        missing = []
+        for file_ in files:
+            if file_.get_filename() in self.indexed:
+                continue
+            try:
+                signature = get_signature(file_)
+            except OSError:
+                continue
+
+            if signature in self.hashes:
+                self.add(file_.get_filename(), signature)
+            else:
+                missing.append(file_)
+        return missing
+
+    def add(self, filename, signature):
+        with self.lock:
+            self.remove(filename)
+            self.indexed[filename] = signature
+            hash_ = self.hashes[signature]
+            if hash_ is not None:
+                self.table.add(hash_, filename)
+
+    # Must be called when a file is renamed, moved or deleted:
+    def remove(self, filename):
+        with self.lock:
+            signature = self.indexed.pop(filename, None)
+            if signature is None:
+                return
+            hash_ = self.hashes[signature]
+            if hash_ is not None:
+                self.table.remove(hash_, filename)
+
+    # This is done in a separate thread:
+    def update(self, files):
+        total = float(len(files)) or 1.0
+        pool = ThreadPool(self.threads)
+        try:
+            results = pool.imap_unordered(get_file_hash, files, chunksize=16)
+            for index, (file_, signature, hash_) in enumerate(results):
+                # The files that can't be hashed aren't tried again:
+                if signature is not None:
+                    with self.lock:
+                        self.hashes[signature] = hash_
+                        self.add(file_.get_filename(), signature)
+                yield index / total
+        finally:
+            pool.close()
+            pool.join()
+
+    # Returns the (distance, filename) of the similar files, nearest first:
+    def find_similar(self, file_, radius=THRESHOLD):
+        with self.lock:
+            signature = self.indexed.get(file_.get_filename())
+            hash_ = self.hashes.get(signature)
+            if hash_ is None:
+                return []
+
+            return [(distance, filename)
+                    for distance, filename in self.table.search(hash_, radius)
+                    if filename != file_.get_filename()]
+
+# Two files never share it, even if they have the same mtime and size
+# (the name is used where the inodes aren't known):
+def get_signature(file_):
+    stat = file_.get_stat()
+    if not stat.st_ino:
+        return (file_.get_filename(), stat.st_mtime, stat.st_size)
+    return (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+
+# This is done in a thread of the pool:
+def get_file_hash(file_):
+    try:
+        signature = get_signature(file_)
+    except OSError as e:
+        print("Warning:", e)
+        return file_, None, None
+
+    try:
+        return file_, signature, file_.get_perceptual_hash()
+    except Exception as e:
+        print("Warning:", e)
+        return file_, signature, None
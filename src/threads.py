@@ -1,4 +1,8 @@
 import time
+import heapq
+import itertools
+import multiprocessing
+
 import gobject
 
 from threading import Thread, Lock, Condition
@@ -10,33 +14,105 @@ gobject.threads_init()
 def yield_processor():
     time.sleep(0.000001)
 
-# Use this thread to postpone work and update the GUI asynchronously.
+# Priority classes of the scheduler (lower values run first):
+PRIORITY_CURRENT = 0     # the image being shown
+PRIORITY_ADJACENT = 1    # the next/previous images and the status
+PRIORITY_GALLERY = 2     # the items of the galleries
+PRIORITY_PINBAR = 3      # the pinbar buckets
+PRIORITY_SPECULATIVE = 4 # prefetching
+
+# Use this pool to postpone work and update the GUI asynchronously.
 # The idea is to push a function and some parameters, and that function
 # will be executed in a separate thread. This function must NOT update
 # the UI directly, it must return another function with its own arguments
 # to be queued in the main thread's event loop with gobject.idle_add.
 # (See http://faq.pygtk.org/index.py?file=faq20.006.htp&req=show)
-class Worker(Thread):
-    def __init__(self):
-        Thread.__init__(self)
+# Jobs are run by priority, and in order of arrival inside the same
+# priority. Every job has a tag, used to cancel all its pending jobs.
+# The jobs of a serial tag run one at a time (like they did when every
+# client had its own worker thread), and some threads are kept for the
+# current and adjacent images, so long background jobs (e.g. hashing a
+# big video) never take the whole pool.
+class Scheduler:
+    RESERVED_THREADS = 1 # only for PRIORITY_CURRENT and PRIORITY_ADJACENT
+
+    def __init__(self, workers=None):
         self.lock = Lock()
         self.cond = Condition(self.lock)
         self.stopped = False
-        self.queue = []
+        self.queue = [] # heap of [priority, sequence, job, params, tag, serial]
+        self.pending = {} # (job, tag, params) -> entry, queued or held
+        self.held = {} # serial tag -> entries waiting for its running job
+        self.running = {} # tag -> number of its jobs being run
+        self.background = 0 # number of jobs being run below PRIORITY_ADJACENT
+        self.sequence = itertools.count()
+        self.threads = []
+
+        workers = max(workers or multiprocessing.cpu_count(),
+                      self.RESERVED_THREADS + 1)
+        for index in range(workers):
+            thread = Thread(target=self.run)
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
 
     def run(self):
         while True:
-            job = None
             with self.cond:
+                entry = self.take()
+                while not entry and not self.stopped:
+                    self.cond.wait()
+                    entry = self.take()
                 if self.stopped:
                     return
-                if not self.queue:
-                    self.cond.wait()
-                else:
-                    job, params = self.queue.pop(0)
-            if not job:
+
+            self.execute(entry[2], entry[3])
+
+            with self.cond:
+                self.finish(entry)
+                self.cond.notify_all()
+
+    # Returns the next entry that can be run now, or None (the lock must
+    # be held):
+    def take(self):
+        while self.queue:
+            entry = self.queue[0]
+            priority, _, job, params, tag, serial = entry
+
+            if serial and tag in self.running:
+                # It will be queued again when the running one finishes:
+                heapq.heappop(self.queue)
+                self.held.setdefault(tag, []).append(entry)
                 continue
-            self.execute(job, params)
+
+            background = priority > PRIORITY_ADJACENT
+            if (background and
+                self.background >= len(self.threads) - self.RESERVED_THREADS):
+                return None
+
+            heapq.heappop(self.queue)
+            del self.pending[get_job_key(job, params, tag)]
+            self.running[tag] = self.running.get(tag, 0) + 1
+            if background:
+                self.background += 1
+            return entry
+
+        return None
+
+    def finish(self, entry):
+        priority, _, _, _, tag, _ = entry
+
+        if priority > PRIORITY_ADJACENT:
+            self.background -= 1
+
+        self.running[tag] -= 1
+        if not self.running[tag]:
+            del self.running[tag]
+            for held in self.held.pop(tag, []):
+                heapq.heappush(self.queue, held)
 
     def execute(self, job, params):
         try:
@@ -51,17 +127,93 @@ class Worker(Thread):
     def stop(self):
         with self.cond:
             self.stopped = True
+            self.queue = []
+            self.pending = {}
+            self.held = {}
             self.cond.notify_all()
 
-    def clear(self):
+        for thread in self.threads:
+            thread.join()
+
+    # Identical pending jobs are pushed only once (with the highest
+    # priority requested):
+    def push(self, job, priority=PRIORITY_SPECULATIVE, tag=None, serial=False):
+        job, params = job
+        key = get_job_key(job, params, tag)
         with self.cond:
-            self.queue = []
-            self.cond.notify_all()
+            entry = self.pending.get(key)
+            if entry:
+                if priority < entry[0]:
+                    entry[0] = priority
+                    heapq.heapify(self.queue)
+                return
 
-    def push(self, job):
+            entry = [priority, next(self.sequence), job, params, tag, serial]
+            self.pending[key] = entry
+            heapq.heappush(self.queue, entry)
+            self.cond.notify()
+
+    def cancel(self, tag):
         with self.cond:
-            self.queue.append(job)
-            self.cond.notify_all()
+            self.queue = [entry for entry in self.queue if entry[4] is not tag]
+            heapq.heapify(self.queue)
+            self.held.pop(tag, None)
+            self.pending = dict((key, entry) for key, entry in self.pending.items()
+                                             if entry[4] is not tag)
+
+    def get_queue(self, priority, tag=None, serial=True):
+        return JobQueue(self, priority, tag, serial)
+
+# The parameters that are plain values (numbers, strings, and tuples of
+# them) are compared by value, since every caller builds them again. The
+# jobs, tags and other parameters are compared by identity, never with ==
+# (which may not be defined for them, see File.__eq__). They are all
+# referenced by the pending entry, so their ids can't be reused meanwhile:
+def get_job_key(job, params, tag):
+    return (getattr(job, "__func__", job),
+            id(getattr(job, "__self__", None)),
+            id(tag),
+            get_param_key(params))
+
+VALUE_TYPES = (type(None), bool, int, float, str, bytes)
+try:
+    VALUE_TYPES += (long, unicode)
+except NameError:
+    pass # Python 3
+
+IDENTITY = object() # marks the keys of the parameters compared by identity
+
+def get_param_key(param):
+    if type(param) in VALUE_TYPES:
+        return param
+    if type(param) is tuple:
+        return tuple(get_param_key(item) for item in param)
+    return (IDENTITY, id(param))
+
+# The jobs of a client of the scheduler, with a fixed priority and tag.
+# They run one at a time, unless the queue isn't serial:
+class JobQueue:
+    def __init__(self, scheduler, priority, tag=None, serial=True):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tag = tag if tag is not None else self
+        self.serial = serial
+
+    def push(self, job):
+        self.scheduler.push(job, self.priority, self.tag, self.serial)
+
+    def clear(self):
+        self.scheduler.cancel(self.tag)
+
+# The pool is shared by the whole application:
+scheduler = None
+
+def get_scheduler():
+    global scheduler
+    if not scheduler:
+        scheduler = Scheduler()
+        scheduler.start()
+    return scheduler
 
 class Updater(Thread):
     def __init__(self, generator, on_progress, on_finish, on_finish_args):
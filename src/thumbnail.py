@@ -8,6 +8,7 @@ from cache import Cache, cached
 
 class DirectoryThumbnail(ImageFile):
     cache = Cache(top_cache=FileScanner.cache)
+    render_cache = Cache(50, top_cache=FileScanner.cache)
     default_thumbnail_size = 512
     default_gtk_icon_size = 128
 
@@ -15,6 +16,26 @@ class DirectoryThumbnail(ImageFile):
         ImageFile.__init__(self, "")
         self.directory = directory
 
+    # Identify the instance by its directory, so the pyramid levels stored
+    # in the pixbuf cache don't collide between different directories:
+    def __hash__(self):
+        return hash(self.directory)
+
+    def get_render_id(self):
+        return self.directory
+
+    # The composite changes with the contents of the directory, so nothing
+    # derived from it can be cached outside of the invalidated caches:
+    def get_original_dimensions(self):
+        pixbuf = self.get_pixbuf()
+        return pixbuf.get_width(), pixbuf.get_height()
+
+    def get_nearest_level(self, width, height):
+        return self.get_pixbuf()
+
+    def can_be_decoded(self):
+        return False
+
     @cached(cache, key_func=lambda self: ("items_count", self.directory))
     def get_items_count(self):
         scanner = FileScanner()
@@ -51,7 +72,7 @@ class DirectoryThumbnail(ImageFile):
 
         width, height = imagefile.get_dimensions_to_fit(size * dir_width,
                                                         size * dir_height)
-        pixbuf = imagefile.get_pixbuf_at_size(width, height)
+        pixbuf = imagefile.get_thumbnail_at_size(width, height)
 
         offset_x = int((ret.get_width() - pixbuf.get_width()) / 2)
         offset_y = int((ret.get_height() * dir_offset) - (pixbuf.get_height()/2))
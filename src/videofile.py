@@ -142,6 +142,9 @@ class VideoFile(ImageFile):
     def can_be_extracted(self):
         return True
 
+    def can_be_decoded(self):
+        return False
+
     def get_extract_args(self):
         return [("Offset", self.parse_duration, "offset", 0),
                 ("Frame rate", float, "rate", 1.0),
@@ -6,10 +6,11 @@ import shutil
 import cgi
 
 import gtk
+import gobject
 
-from imagefile import Size, GTKIconImage
+from imagefile import Size, ImageFile, GTKIconImage
 from filemanager import Action, FileManager
-from gallery import GalleryViewer
+from gallery import GalleryViewer, DuplicatesViewer, SelectorListStoreBuilder
 from chooser import (OpenDialog, BasedirSelectorDialog, TargetSelectorDialog,
                      RenameDialog, DirectorySelectorDialog, OutputDialog)
 from dialogs import (InfoDialog, ErrorDialog, AboutDialog, TextEntryDialog,
@@ -17,15 +18,27 @@ from dialogs import (InfoDialog, ErrorDialog, AboutDialog, TextEntryDialog,
 from imageviewer import ImageViewer, ThumbnailViewer
 from thumbnail import DirectoryThumbnail
 from downloader import MultiDownloader
+from duplicates import DuplicateFinder
+from phash import SimilarityIndex
+from filefactory import FileFactory
 
 from archivefile import ArchiveGenerator
-from giffile import GIFGenerator
-from pdffile import PDFGenerator
+from giffile import GIFFile, GIFGenerator
+from pdffile import PDFFile, PDFGenerator
+from epubfile import EPUBFile
+from videofile import VideoFile
 
 from filescanner import FileFilter, FileScanner
 from system import get_process_memory_usage, execute
 
-from threads import Worker, Updater
+from latency import tracker
+from governor import MemoryGovernor
+from journal import Journal
+from cache import PersistentCache
+import decoder
+import mover
+from threads import (Updater, get_scheduler, PRIORITY_CURRENT,
+                     PRIORITY_ADJACENT, PRIORITY_PINBAR, PRIORITY_SPECULATIVE)
 
 class BlockedWidget:
     def __init__(self, widget, handler_id):
@@ -262,6 +275,12 @@ class Pinbar:
         self.target_array = []
         self.label_array = []
 
+        # Buckets whose directory changed since they were drawn:
+        self.dirty_buckets = set()
+        self.refresh_pending = False
+        FileScanner.cache.add_chained(self)
+        self.loader = get_scheduler().get_queue(PRIORITY_PINBAR)
+
         factory = WidgetFactory()
 
         # Pinbar hbox
@@ -369,11 +388,39 @@ class Pinbar:
                                     self.main_app.last_targets,
                                     on_dir_selected).run()
 
+    # Invoked when the contents of a directory change (chained to the
+    # FileScanner cache). Only the affected buckets are redrawn, once the
+    # caches have been invalidated:
+    def invalidate(self, partial_key):
+        for index, target in enumerate(self.target_array):
+            if target and target == partial_key:
+                self.dirty_buckets.add(index)
+
+        if self.dirty_buckets and not self.refresh_pending:
+            self.refresh_pending = True
+            gobject.idle_add(self.on_refresh_buckets)
+
+    def on_refresh_buckets(self):
+        self.refresh_pending = False
+        self.refresh_buckets()
+        return False
+
     def refresh_buckets(self):
         if self.is_active():
-            for index in range(self.THUMB_COUNT):
+            for index in sorted(self.dirty_buckets):
                 thumb = self.thumb_array[index]
-                thumb.redraw()
+                self.loader.push((self.prepare_bucket, (thumb, thumb.image_file)))
+            self.dirty_buckets.clear()
+
+    # This is done in a separate thread:
+    def prepare_bucket(self, thumb, imgfile):
+        thumb.get_thumbnail(imgfile)
+        return (self.redraw_bucket, (thumb, imgfile))
+
+    # This is requested to be done by the main thread:
+    def redraw_bucket(self, thumb, imgfile):
+        if thumb.image_file is imgfile:
+            thumb.redraw()
 
     def send_to_target(self, index):
         target = self.target_array[index]
@@ -403,6 +450,7 @@ class Pinbar:
 
     def set_target(self, index, imgfile, dirname):
         thumb = self.thumb_array[index]
+        self.dirty_buckets.discard(index)
 
         if imgfile:
             thumb.load(imgfile)
@@ -430,26 +478,46 @@ class Pinbar:
     def show(self):
         self.active = True
         self.get_widget().show()
+        self.refresh_buckets()
 
     def is_active(self):
         return self.active
 
+# The actions that change files are also written to the journal (if
+# any), so they can be undone after a restart:
 class UndoStack:
-    def __init__(self, on_push, on_stack_empty):
+    def __init__(self, on_push, on_stack_empty, journal=None):
         self.stack = []
         self.on_push = on_push
         self.on_stack_empty = on_stack_empty
+        self.journal = journal
 
     def clear(self):
         self.stack = []
+        if self.journal:
+            self.journal.clear()
         self.on_stack_empty()
 
     def push(self, action):
         if not action:
             return
+        if not action.pending:
+            self.write(action)
         self.stack.append(action)
         self.on_push(action)
 
+    # The actions done in the background are journaled when they finish
+    # (unless they have been undone meanwhile):
+    def on_action_done(self, action):
+        if action in self.stack:
+            self.write(action)
+
+    def write(self, action):
+        if self.journal and action.changes and action.journal_id is None:
+            action.journal_id = self.journal.push(action.severity,
+                                                  action.description,
+                                                  action.changes)
+
     def empty(self):
         return not self.stack
 
@@ -458,6 +526,8 @@ class UndoStack:
 
     def pop(self):
         action = self.stack.pop()
+        if self.journal and action.journal_id is not None:
+            self.journal.pop(action.journal_id)
         if self.empty():
             self.on_stack_empty()
         return action
@@ -467,20 +537,55 @@ class ViewerApp:
     DEF_HEIGHT = 768
     TH_SIZE = 200
     BG_COLOR = "#000000"
+    SCROLL_SETTLE_TIME = 150 # ms
 
-    def __init__(self, files, start_file, base_dir=None):
+    def __init__(self, files, start_file, base_dir=None, prefetch_ahead=4,
+                                                          prefetch_behind=1,
+                                                          latency_overlay=False,
+                                                          memory_limits=None):
         ### Data definition
-        self.file_manager = FileManager(self.on_list_modified)
+        self.file_manager = FileManager(self.on_list_modified,
+                                        self.on_action_done)
+
+        # Files decoded in advance, following the direction of travel:
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self.last_index = 0
+        self.direction = 1
+
+        # Navigation bursts (thumbnail scrolling) are coalesced, and the
+        # full reload is done once the burst settles:
+        self.navigation_burst = False
+        self.settle_timer = None
+
+        # Status values computed in a separate thread (the generation
+        # discards the values of previous requests):
+        self.status_file = None
+        self.status_values = {}
+        self.status_generation = 0
 
         self.files_order = None
         self.base_dir = base_dir
         self.last_targets = []
+        self.journal = self.open_journal()
         self.undo_stack = UndoStack(self.on_undo_stack_push,
-                                    self.on_undo_stack_empty)
+                                    self.on_undo_stack_empty,
+                                    self.journal)
         self.filter_ = FileFilter()
+        self.similarity_index = SimilarityIndex()
 
         self.fullview_active = False
 
+        # Loaders (created before the viewers that use them), all of them
+        # share the application pool:
+        scheduler = get_scheduler()
+        self.main_loader = scheduler.get_queue(PRIORITY_CURRENT)
+        self.refine_loader = scheduler.get_queue(PRIORITY_CURRENT)
+        self.loader_left = scheduler.get_queue(PRIORITY_ADJACENT)
+        self.loader_right = scheduler.get_queue(PRIORITY_ADJACENT)
+        self.status_loader = scheduler.get_queue(PRIORITY_ADJACENT)
+        self.prefetcher = scheduler.get_queue(PRIORITY_SPECULATIVE)
+
         ### Window composition
         factory = WidgetFactory()
         self.widget_manager = WidgetManager()
@@ -538,7 +643,7 @@ class ViewerApp:
         hbox.pack_start(ebox, False, False, 0)
 
         # Main viewer
-        self.image_viewer = ImageViewer()
+        self.image_viewer = ImageViewer(refiner=self.refine_loader, tiled=True)
         self.scrolled = AutoScrolledWindow(child=self.image_viewer.get_widget(),
                                            bg_color=self.BG_COLOR,
                                            on_special_drag_left=self.on_viewer_drag_left,
@@ -547,6 +652,24 @@ class ViewerApp:
                                            on_size_allocate=self.on_viewer_size_allocate)
         hbox.pack_start(self.scrolled.get_widget(), True, True, 0)
 
+        # Caches shrunk under memory pressure, the cheapest to rebuild first
+        # (the full decodes are the last ones):
+        self.governor = None
+        if memory_limits:
+            caches = [("tiles", self.image_viewer.tile_cache),
+                      ("thumbnails", ThumbnailViewer.thumbnail_cache),
+                      ("directory thumbnails", DirectoryThumbnail.render_cache),
+                      ("rendered", ImageFile.render_cache),
+                      ("liststores", SelectorListStoreBuilder.liststore_cache),
+                      ("animations", GIFFile.pixbuf_anim_cache),
+                      ("directory composites", DirectoryThumbnail.cache),
+                      ("EPUB pages", EPUBFile.pixbuf_cache),
+                      ("PDF pages", PDFFile.pixbuf_cache),
+                      ("video frames", VideoFile.video_cache),
+                      ("pixbufs", ImageFile.pixbuf_cache)]
+            self.governor = MemoryGovernor(caches, *memory_limits)
+            self.governor.start()
+
         # Right thumbnail
         self.th_right = ThumbnailViewer(self.TH_SIZE)
         ebox = factory.get_event_box(child=self.th_right.get_widget(),
@@ -583,22 +706,25 @@ class ViewerApp:
         self.status_bar.pack_start(self.file_info, False, False, 10)
         self.status_bar.pack_end(self.file_index, False, False, 10)
 
-        # Window composition end
+        # Latency percentiles (only shown on demand):
+        self.latency_info = gtk.Label()
+        self.latency_info.set_no_show_all(True)
+        self.status_bar.pack_end(self.latency_info, False, False, 10)
+        if latency_overlay:
+            tracker.on_update = self.refresh_latency
+            self.latency_info.show()
 
-        # Loaders pool:
-        self.pool = []
-        self.main_loader = Worker()
-        self.loader_left = Worker()
-        self.loader_right = Worker()
-        self.pool.append(self.main_loader)
-        self.pool.append(self.loader_left)
-        self.pool.append(self.loader_right)
+        # Progress of the moves to other devices:
+        self.moves_info = gtk.Label()
+        self.moves_info.set_no_show_all(True)
+        self.status_bar.pack_end(self.moves_info, False, False, 10)
+        mover.get_mover().on_progress = self.refresh_moves
 
-        for worker in self.pool:
-            worker.start()
+        # Window composition end
 
         # Initial set of files:
         self.set_files(files, start_file)
+        self.restore_journal()
 
         # Show main window AFTER obtaining file list
         self.window.show_all()
@@ -631,12 +757,21 @@ class ViewerApp:
                              "handler" : self.on_mass_download},
                             {"text" : "Mass delete...",
                              "handler" : self.on_mass_delete},
+                            {"text" : "Mass move...",
+                             "handler" : self.on_mass_move},
+                            {"text" : "Find duplicates in list",
+                             "handler" : self.on_find_duplicates},
+                            {"text" : "Find duplicates in directory...",
+                             "handler" : self.on_find_duplicates_in_dir},
                             {"separator" : True},
                             {"text" : "Open in nautilus",
                              "handler" : self.on_open_in_nautilus},
                             {"stock" : gtk.STOCK_INFO,
                              "accel" : (gtk.keysyms.comma, 0),
                              "handler" : self.on_show_info},
+                            {"text" : "Show similar images",
+                             "accel" : "<Control>S",
+                             "handler" : self.on_show_similar},
                             {"text" : "Open in external viewer",
                              "accel" : "X",
                              "handler" : self.on_external_open},
@@ -1155,6 +1290,29 @@ class ViewerApp:
 
         factory.add_default()
 
+    def open_journal(self):
+        journal = Journal(os.path.join(PersistentCache.default_dir, "undo.journal"))
+        try:
+            if journal.open():
+                return journal
+            print("Warning: the undo journal is in use by another instance")
+        except (IOError, OSError) as e:
+            print("Warning:", e)
+        return None
+
+    # The actions not undone in previous sessions:
+    def restore_journal(self):
+        if not self.journal:
+            return
+
+        for entry in self.journal.get_entries():
+            action = self.file_manager.get_journaled_action(
+                         entry["severity"],
+                         "%s (previous session)" % entry["description"],
+                         entry["changes"])
+            action.journal_id = entry["id"]
+            self.undo_stack.push(action)
+
     def set_files(self, files, start_file):
         self.file_manager.set_files(files)
 
@@ -1185,9 +1343,15 @@ class ViewerApp:
 
     ## Gtk event handlers
     def on_destroy(self, widget):
-        for worker in self.pool:
-            worker.stop()
-            worker.join()
+        get_scheduler().stop()
+        mover.stop()
+        if self.governor:
+            self.governor.stop()
+        tracker.close()
+        decoder.close()
+        if self.journal:
+            self.journal.close()
+        ImageFile.metadata_cache.close()
         gtk.main_quit()
 
     def on_key_press_event(self, widget, event, data=None):
@@ -1196,6 +1360,11 @@ class ViewerApp:
 
         bindings = self.get_key_bindings()
 
+        # The menu accelerators are handled after this handler, so the
+        # trace is finished once everything has been processed:
+        tracker.start(key_name)
+        gobject.idle_add(tracker.finish)
+
         if key_name in bindings:
             bindings[key_name]()
 
@@ -1210,10 +1379,14 @@ class ViewerApp:
         self.on_go_forward(None)
 
     def on_th_scroll(self, widget, event, data=None):
-        if event.direction == gtk.gdk.SCROLL_UP:
-            self.on_go_back(None)
-        else:
-            self.on_go_forward(None)
+        self.navigation_burst = True
+        try:
+            if event.direction == gtk.gdk.SCROLL_UP:
+                self.on_go_back(None)
+            else:
+                self.on_go_forward(None)
+        finally:
+            self.navigation_burst = False
 
     # not real gtk events:
     def on_viewer_drag_left(self): self.on_go_back(None)
@@ -1272,12 +1445,33 @@ class ViewerApp:
         self.undo_stack.push(self.file_manager.rename_current(new_name))
 
     def on_list_modified(self):
+        tracker.stage("navigate")
+
+        if self.navigation_burst:
+            self.quick_reload_viewer()
+            self.remove_settle_timer()
+            self.settle_timer = gobject.timeout_add(self.SCROLL_SETTLE_TIME,
+                                                    self.on_navigation_settled)
+        else:
+            self.reload_viewer()
+
+    def on_navigation_settled(self):
+        self.settle_timer = None
         self.reload_viewer()
+        return False
 
     def on_undo_stack_push(self, item):
         self.widget_manager.get("undo_mitem").set_sensitive(True)
         self.widget_manager.get("undo_button").set_sensitive(True)
 
+        # The names of the files moved or deleted are no longer valid:
+        for change in item.changes:
+            if change[0] in ("move", "trash"):
+                self.similarity_index.remove(change[1])
+
+    def on_action_done(self, action):
+        self.undo_stack.on_action_done(action)
+
     def on_undo_stack_empty(self):
         self.widget_manager.get("undo_mitem").set_sensitive(False)
         self.widget_manager.get("undo_button").set_sensitive(False)
@@ -1314,7 +1508,46 @@ class ViewerApp:
         finally:
             pass
 
+    def remove_settle_timer(self):
+        if self.settle_timer:
+            gobject.source_remove(self.settle_timer)
+            self.settle_timer = None
+
+    # Only what is already cached is shown, without decoding anything
+    # (not even to get the dimensions of a video or a PDF). The full reload
+    # is done later by reload_viewer:
+    def quick_reload_viewer(self):
+        current_file = self.file_manager.get_current_file()
+        current_file.set_anim_enabled(False)
+        missing_image = GTKIconImage(gtk.STOCK_MISSING_IMAGE, 128)
+
+        width, height = self.image_viewer.get_size()
+        if current_file.can_be_refined() and \
+           current_file.has_dimensions() and \
+           current_file.is_rendered(*self.image_viewer.get_fit_size(current_file,
+                                                                    width,
+                                                                    height)):
+            self.image_viewer.load(current_file)
+        else:
+            self.image_viewer.load(missing_image)
+        self.fit_viewer(force=True)
+
+        self.th_left.load_if_cached(self.file_manager.get_prev_file(), missing_image)
+        self.th_right.load_if_cached(self.file_manager.get_next_file(), missing_image)
+
+        # The status of the previous file is no longer needed:
+        self.status_generation += 1
+        self.status_loader.clear()
+
+        self.refresh_title()
+        self.refresh_filename()
+        self.file_index.set_markup("<b><big>%d/%d</big></b>" %
+                                   (self.file_manager.get_current_index() + 1,
+                                    self.file_manager.get_list_length()))
+
     def reload_viewer(self):
+        self.remove_settle_timer()
+
         current_file = self.file_manager.get_current_file()
         current_file.set_anim_enabled(False)
 
@@ -1340,6 +1573,8 @@ class ViewerApp:
         self.main_loader.clear()
         self.main_loader.push((self.preload_main_viewer,
                                (self.image_viewer, current_file)))
+        self.update_direction()
+        self.prefetch_files()
 
         # Handle extract buttons
         self.widget_manager.get("extract_mitem").set_sensitive(current_file.can_be_extracted())
@@ -1353,10 +1588,8 @@ class ViewerApp:
         self.widget_manager.set_active("zoom_to_fit_toggle", True)
         self.widget_manager.set_active("zoom_to_fit_button", True)
 
-        # Refresh the pinbar buckets
-        self.pinbar.refresh_buckets()
-
         self.refresh_info()
+        tracker.stage("update")
 
     # This function will load the animated GIF in a separate thread:
     def preload_main_viewer(self, viewer, file_):
@@ -1379,9 +1612,64 @@ class ViewerApp:
     def load_main_viewer(self, viewer, file_):
         self.fit_viewer(force=True)
 
+    def update_direction(self):
+        index = self.file_manager.get_current_index()
+        length = self.file_manager.get_list_length()
+
+        # Take into account going around the end of the list:
+        delta = index - self.last_index
+        if delta > length / 2:
+            delta -= length
+        elif delta < -length / 2:
+            delta += length
+
+        if delta:
+            self.direction = 1 if delta > 0 else -1
+        self.last_index = index
+
+    def get_prefetch_offsets(self):
+        ahead = [self.direction * i for i in range(1, self.prefetch_ahead + 1)]
+        behind = [-self.direction * i for i in range(1, self.prefetch_behind + 1)]
+
+        # Nearest files first:
+        offsets = []
+        for index in range(max(len(ahead), len(behind))):
+            offsets.extend(ahead[index:index+1] + behind[index:index+1])
+        return offsets
+
+    # Stale requests are discarded, since the window moved:
+    def prefetch_files(self):
+        self.prefetcher.clear()
+
+        if self.file_manager.empty():
+            return
+
+        current_file = self.file_manager.get_current_file()
+        width, height = self.image_viewer.get_size()
+        files = []
+
+        for offset in self.get_prefetch_offsets():
+            file_ = self.file_manager.get_file_at_offset(offset)
+            if file_ is not current_file and file_ not in files:
+                files.append(file_)
+
+        for file_ in files:
+            self.prefetcher.push((self.prefetch_file, (file_, width, height)))
+
+    # This function will render the file at the size used by fit_viewer
+    # in a separate thread (it will be obtained and cached):
+    def prefetch_file(self, file_, width, height):
+        if file_.can_be_refined():
+            file_.get_pixbuf_at_size(*self.image_viewer.get_fit_size(file_,
+                                                                     width,
+                                                                     height))
+        return (None, None)
+
     # This function will preload the thumbnail in a separate thread:
     def prepare_thumbnail(self, thumb, file_):
-        file_.get_pixbuf() # it will be obtained and cached
+        # The embedded thumbnail or the decoded image will be cached:
+        file_.get_thumbnail_at_size(*file_.get_dimensions_to_fit(thumb.th_size,
+                                                                thumb.th_size))
         return (thumb.load, (file_,))
 
     def fit_viewer(self, force=False):
@@ -1407,18 +1695,73 @@ class ViewerApp:
         markup = "<b><span foreground='white'>%s</span></b>" % filename
         self.file_name.set_markup(markup)
 
+    # The slow values (hashing, directory listing, decoding, /proc) are
+    # computed by the status loader, and filled as they arrive. The values
+    # of the previous file are kept until then if the file didn't change:
     def refresh_status(self):
         image_file = self.file_manager.get_current_file()
 
+        if image_file is not self.status_file:
+            self.status_file = image_file
+            self.status_values = {}
+
+        self.status_generation += 1
+        self.status_loader.clear()
+
+        # Quickest first:
+        jobs = [("dimensions", image_file.get_dimensions, ()),
+                ("memory", get_process_memory_usage, ()),
+                ("dir_files", self.count_dir_files, (image_file.get_dirname(),)),
+                ("sha1", image_file.get_sha1, ())]
+
+        for name, func, args in jobs:
+            self.status_loader.push((self.compute_status_value,
+                                    (self.status_generation, name, func, args)))
+
+        self.show_status()
+
+    # This is done in a separate thread (None is posted if the value
+    # can't be computed, e.g. the file is gone):
+    def compute_status_value(self, generation, name, func, args):
+        try:
+            value = func(*args)
+        except Exception as e:
+            print("Warning:", e)
+            value = None
+        return (self.on_status_value, (generation, name, value))
+
+    # This is requested to be done by the main thread:
+    def on_status_value(self, generation, name, value):
+        if generation == self.status_generation:
+            self.status_values[name] = value
+            self.show_status()
+
+    def count_dir_files(self, directory):
+        scanner = FileScanner()
+        return len(scanner.get_files_from_dir(directory))
+
+    def show_status(self):
+        image_file = self.status_file
+        values = self.status_values
+
+        def get_value(name, format_=str):
+            if name not in values:
+                return "<i>...</i>"
+            elif values[name] is None:
+                return "<i>n/a</i>"
+            return format_(values[name])
+
         # Markup reference:
         # http://www.gtk.org/api/2.6/pango/PangoMarkupFormat.html
 
+        dimensions = get_value("dimensions", lambda value: "%s pixels" % value)
+
         file_info  = "<i>Date:</i> %s | " % image_file.get_mtime()
-        file_info += "<i>Dimensions:</i> %s pixels | " % image_file.get_dimensions()
+        file_info += "<i>Dimensions:</i> %s | " % dimensions
         file_info += "<i>Size:</i> %s | " % image_file.get_filesize()
         file_info += "<i>Zoom:</i> %d%% | " % self.image_viewer.get_zoom_factor()
         file_info += "<i>Rotation:</i> %d degrees\n" % image_file.get_rotation()
-        file_info += "<i>SHA1:</i> %s" % image_file.get_sha1()
+        file_info += "<i>SHA1:</i> %s" % get_value("sha1")
 
         file_info += "\n<i>Base directory:</i> <b>%s</b>" % self.base_dir
 
@@ -1438,24 +1781,46 @@ class ViewerApp:
             span += ">%s</span>" % last_action.description
             file_info += "\n<i>Last action:</i> " + span
 
-        scanner = FileScanner()
-        files = scanner.get_files_from_dir(image_file.get_dirname())
-
         inverse_order = self.widget_manager.get("inverted_order_toggle").active
-        file_index = "<b><big>%d/%d</big></b> (%d)\n<i>Order:</i> %s %s" % \
+        file_index = "<b><big>%d/%d</big></b> (%s)\n<i>Order:</i> %s %s" % \
                      (self.file_manager.get_current_index() + 1,
                       self.file_manager.get_list_length(),
-                      len(files),
+                      get_value("dir_files"),
                       self.files_order,
                       "Desc" if inverse_order else "Asc")
 
-        rss, vsize = get_process_memory_usage()
-        file_index += "\n<i>RSS:</i> %s\n<i>VSize:</i> %s" % (Size(rss), Size(vsize))
+        file_index += "\n<i>RSS:</i> %s\n<i>VSize:</i> %s" % \
+                      (get_value("memory", lambda value: Size(value[0])),
+                       get_value("memory", lambda value: Size(value[1])))
 
         self.file_info.set_markup(file_info)
         self.file_index.set_markup(file_index)
         self.file_index.set_justify(gtk.JUSTIFY_RIGHT)
 
+    def refresh_latency(self):
+        lines = []
+        for name in tracker.get_stages():
+            lines.append("<i>%s:</i> %.1f / %.1f / %.1f ms" %
+                         ((name,) + tracker.get_percentiles(name)))
+        self.latency_info.set_markup("<small><b>p50 / p95 / p99</b>\n%s</small>" %
+                                     "\n".join(lines))
+
+    def refresh_moves(self):
+        move, percent, waiting = mover.get_mover().get_status()
+
+        lines = []
+        if move:
+            lines.append("<i>Moving</i> %s: %d%%" %
+                         (cgi.escape(os.path.basename(move.source)), percent))
+        if waiting:
+            lines.append("%d more waiting" % waiting)
+
+        if lines:
+            self.moves_info.set_markup("<small>%s</small>" % "\n".join(lines))
+            self.moves_info.show()
+        else:
+            self.moves_info.hide()
+
     def reorder_files(self):
         inverse_order = self.widget_manager.get("inverted_order_toggle").active
 
@@ -1466,10 +1831,27 @@ class ViewerApp:
         elif self.files_order == "Size":
             self.file_manager.sort_by_size(inverse_order)
         elif self.files_order == "Dimensions":
-            self.file_manager.sort_by_dimensions(inverse_order)
+            if self.file_manager.has_dimensions():
+                self.file_manager.sort_by_dimensions(inverse_order)
+            else:
+                dialog = ProgressBarDialog(self.window, "Reading dimensions...")
+                dialog.show()
+                updater = Updater(self.file_manager.read_dimensions(),
+                                  dialog.update,
+                                  self.on_dimensions_read,
+                                  (dialog,))
+                updater.start()
         else:
             assert(False)
 
+    def on_dimensions_read(self, dialog):
+        try:
+            dialog.destroy()
+        finally:
+            # The order may have changed in the meantime:
+            if self.files_order == "Dimensions":
+                self.reorder_files()
+
     def handle_args(self, args):
         kw_args = {}
         for arg, func, key, default in args:
@@ -1751,19 +2133,30 @@ class ViewerApp:
         finally:
             shutil.rmtree(tmp_dir)
 
-    def on_mass_delete(self, _):
+    def get_range(self, verb):
         current, total = (self.file_manager.get_current_index() + 1,
                           self.file_manager.get_list_length())
 
-        args = [("First file to delete (current: %d)" % current, int, 1),
-                ("Last file to delete (current: %d)" % current, int, total)]
+        args = [("First file to %s (current: %d)" % (verb, current), int, 1),
+                ("Last file to %s (current: %d)" % (verb, current), int, total)]
 
-        initial, final = self.get_args(args)
+        range_ = self.get_args(args)
+        if not range_:
+            return None
 
+        initial, final = range_
         if not initial <= final or initial < 1 or final > total:
             ErrorDialog(self.window, "Invalid range: %d - %d" % (initial, final)).run()
+            return None
+
+        return initial, final
+
+    def on_mass_delete(self, _):
+        range_ = self.get_range("delete")
+        if not range_:
             return
 
+        initial, final = range_
         dialog = QuestionDialog(self.window,
                                 "Are you sure you want to delete from %d to %d?" \
                                  % (initial, final))
@@ -1771,14 +2164,83 @@ class ViewerApp:
         if not dialog.run():
             return
 
-        dialog = ProgressBarDialog(self.window, "Deleting files...")
+        self.run_batch(self.file_manager.mass_delete(initial - 1, final - 1),
+                       "Deleting files...")
+
+    def on_mass_move(self, _):
+        range_ = self.get_range("move")
+        if not range_:
+            return
+
+        initial, final = range_
+        def on_target_selected(target_dir):
+            self.update_target(target_dir)
+            self.run_batch(self.file_manager.mass_move(initial - 1, final - 1,
+                                                       target_dir),
+                           "Moving files...")
+
+        selector = TargetSelectorDialog(parent=self.window,
+                                        initial_dir=self.get_base_dir(),
+                                        last_targets=self.last_targets,
+                                        callback=on_target_selected)
+        selector.run()
+
+    def run_batch(self, batch, text):
+        dialog = ProgressBarDialog(self.window, text)
         dialog.show()
-        updater = Updater(self.file_manager.mass_delete(initial - 1, final - 1),
+        updater = Updater(batch.run(),
                           dialog.update,
-                          lambda dialog: dialog.destroy(),
-                          (dialog,))
+                          self.on_batch_finished,
+                          (batch, dialog))
+        updater.start()
+
+    def on_batch_finished(self, batch, dialog):
+        try:
+            dialog.destroy()
+        finally:
+            self.undo_stack.push(self.file_manager.finish_batch(batch))
+
+    def on_find_duplicates(self, _):
+        self.find_duplicates(self.file_manager.get_files())
+
+    def on_find_duplicates_in_dir(self, _):
+        def on_dir_selected(dirname):
+            scanner = FileScanner(recursive=True)
+            filenames, start_file = scanner.get_files_from_args([dirname])
+            self.find_duplicates(list(map(FileFactory.create, filenames)))
+
+        DirectorySelectorDialog("Select directory to search for duplicates",
+                                self.window,
+                                self.get_base_dir(),
+                                self.last_targets,
+                                on_dir_selected).run()
+
+    def find_duplicates(self, files):
+        finder = DuplicateFinder(files)
+        dialog = ProgressBarDialog(self.window, "Searching for duplicates...")
+        dialog.show()
+        updater = Updater(finder.run(),
+                          dialog.update,
+                          self.on_duplicates_found,
+                          (finder, dialog))
         updater.start()
 
+    def on_duplicates_found(self, finder, dialog):
+        dialog.destroy()
+
+        if not finder.groups:
+            InfoDialog(self.window, "No duplicates found").run()
+            return
+
+        def on_trash(files):
+            self.run_batch(self.file_manager.delete_files(files),
+                           "Deleting duplicates...")
+
+        viewer = DuplicatesViewer(parent=self.window,
+                                  finder=finder,
+                                  callback=on_trash)
+        viewer.run()
+
     def on_open_in_nautilus(self, widget):
         current_file = self.file_manager.get_current_file()
         execute(["nautilus", current_file.get_filename()])
@@ -1941,6 +2403,45 @@ class ViewerApp:
         dialog = TabbedInfoDialog(self.window, metadata)
         dialog.show()
 
+    # The images not indexed yet are hashed first (the hashes are kept in
+    # the metadata cache, so this is only slow the first time):
+    def on_show_similar(self, _):
+        current_file = self.file_manager.get_current_file()
+        missing = self.similarity_index.get_missing(self.file_manager.get_files())
+
+        if not missing:
+            self.show_similar(current_file)
+            return
+
+        dialog = ProgressBarDialog(self.window, "Hashing images...")
+        dialog.show()
+        updater = Updater(self.similarity_index.update(missing),
+                          dialog.update,
+                          self.on_similarity_index_updated,
+                          (current_file, dialog))
+        updater.start()
+
+    def on_similarity_index_updated(self, current_file, dialog):
+        dialog.destroy()
+        self.show_similar(current_file)
+
+    def show_similar(self, current_file):
+        # The index may know files of other lists:
+        files = [self.file_manager.get_listed_file(filename)
+                 for distance, filename
+                 in self.similarity_index.find_similar(current_file)
+                 if self.file_manager.is_listed(filename)]
+
+        if not files:
+            InfoDialog(self.window, "No similar images found").run()
+            return
+
+        gallery = GalleryViewer(title="Similar images",
+                                parent=self.window,
+                                files=files,
+                                callback=self.file_manager.go_file)
+        gallery.run()
+
     def on_external_open(self, _):
         current_file = self.file_manager.get_current_file()
         current_file.external_open()